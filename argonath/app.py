@@ -1,14 +1,18 @@
 # coding: utf-8
 
+import time
 import logging
+from collections import OrderedDict
 
-from flask import Flask, request, g, session
+from flask import Flask, request, g, session, current_app
 from werkzeug.utils import import_string
 
 from argonath.ext import db
-from argonath.models import User
+from argonath.models import User, reference, skydns_mirror, health_monitor, _get_etcd
 from argonath.utils import paginator_kwargs
 
+logger = logging.getLogger(__name__)
+
 blueprints = (
     'index',
     'record',
@@ -17,7 +21,26 @@ blueprints = (
     'user',
 )
 
+
+class _Timer(object):
+    """记每一步花了多久, 启动的时候打出来"""
+
+    def __init__(self):
+        self.timings = []
+        self.last = time.time()
+
+    def __call__(self, name):
+        now = time.time()
+        self.timings.append((name, now - self.last))
+        self.last = now
+
+    def report(self, what):
+        logger.info('%s in %.3fs: %s', what, sum(t for _, t in self.timings),
+                    ', '.join('%s %.3fs' % item for item in self.timings))
+
+
 def create_app():
+    timer = _Timer()
     app = Flask(__name__, static_url_path='/argonath/static')
     app.config.from_object('argonath.config')
     app.config.setdefault('SQLALCHEMY_TRACK_MODIFICATIONS', True)
@@ -25,21 +48,73 @@ def create_app():
 
     logging.basicConfig(format='%(levelname)s:%(asctime)s:%(message)s',
                         level=logging.INFO)
+    timer('config')
 
     for ext in (db, ):
         ext.init_app(app)
+    timer('extensions')
 
     for bp in blueprints:
         import_name = '%s.views.%s:bp' % (__package__, bp)
         app.register_blueprint(import_string(import_name))
+        timer('blueprint %s' % bp)
 
     for fl in (max, min, paginator_kwargs):
         app.add_template_global(fl)
 
     @app.before_request
     def init_global_vars():
-        g.user = 'id' in session and User.get(session['id']) or None
+        # api 自己用 token 鉴权, 不用再查一遍 session 里的用户
+        if request.blueprint != 'api':
+            g.user = 'id' in session and User.get_cached(session['id']) or None
         g.start = request.args.get('start', type=int, default=0)
         g.limit = request.args.get('limit', type=int, default=20)
+        g.before = request.args.get('before', type=int, default=None)
 
+    timer.report('app created')
+    app.startup_timings = timer.timings
     return app
+
+
+def _warm_mirror(timeout=10):
+    """等镜像第一次同步完, 最多等 timeout 秒"""
+    deadline = time.time() + timeout
+    while not skydns_mirror.fresh() and time.time() < deadline:
+        time.sleep(0.1)
+
+
+def _warm_templates():
+    for name in current_app.jinja_env.list_templates(extensions=['html']):
+        current_app.jinja_env.get_template(name)
+
+
+# WARMUP 里可以写的名字, 按这个顺序跑
+WARMUPS = OrderedDict([
+    ('etcd', _get_etcd),
+    ('reference', lambda: (reference.get('domain'), reference.get('cidr'))),
+    ('mirror', _warm_mirror),
+    ('health', health_monitor.start),
+    ('templates', _warm_templates),
+])
+
+
+def warm_up(app, names=None):
+    """worker 开始接请求之前把 WARMUP 里列的先跑一遍, 失败了只打日志"""
+    if names is None:
+        names = [n.strip() for n in app.config.get('WARMUP', '').split(',') if n.strip()]
+    timer = _Timer()
+    with app.app_context():
+        for name in names:
+            if name not in WARMUPS:
+                logger.warning('unknown warm up %s', name)
+                continue
+            try:
+                WARMUPS[name]()
+            except Exception:
+                logger.exception('warm up %s failed', name)
+            timer(name)
+        db.session.remove()
+    if names:
+        timer.report('warmed up')
+    app.startup_timings = getattr(app, 'startup_timings', []) + timer.timings
+    return timer.timings
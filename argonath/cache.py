@@ -0,0 +1,43 @@
+# coding: utf-8
+
+import time
+import threading
+
+
+class TTLCache(object):
+    """进程内的 TTL 缓存, 每个 gunicorn worker 一份, 满了就整个清掉"""
+
+    def __init__(self, ttl=60, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires = item
+        if expires < time.time():
+            self._data.pop(key, None)
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            if len(self._data) >= self.maxsize:
+                self._data.clear()
+            self._data[key] = (value, time.time() + (self.ttl if ttl is None else ttl))
+
+    def incr(self, key, delta=1):
+        """只改已经缓存了的值, 不在缓存里就算了"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                self._data[key] = (item[0] + delta, item[1])
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
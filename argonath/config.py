@@ -9,6 +9,8 @@ MYSQL_PORT = int(os.getenv('MYSQL_PORT', '3306'))
 MYSQL_USER = os.getenv('MYSQL_USER', 'root')
 MYSQL_PASSWORD = os.getenv('MYSQL_PASSWORD', '')
 MYSQL_DATABASE = os.getenv('MYSQL_DATABASE', 'argonath')
+# 空的是 MySQL-python, gevent worker 要用纯 python 的 pymysql, 不然查库会卡住整个 worker
+MYSQL_DRIVER = os.getenv('MYSQL_DRIVER', '')
 
 SQLALCHEMY_POOL_SIZE = 100
 SQLALCHEMY_POOL_TIMEOUT = 10
@@ -16,6 +18,56 @@ SQLALCHEMY_POOL_RECYCLE = 2000
 
 DEFAULT_NET = 'default'
 ETCDS = os.getenv('ETCDS', 'localhost:4001')
+# 进程内镜像 /skydns, 读 hosts 不再每次请求 etcd
+ETCD_MIRROR = bool(os.getenv('ETCD_MIRROR', ''))
+ETCD_MIRROR_MAX_LAG = int(os.getenv('ETCD_MIRROR_MAX_LAG', '30'))
+ETCD_MIRROR_WATCH_TIMEOUT = int(os.getenv('ETCD_MIRROR_WATCH_TIMEOUT', '10'))
+# etcd 成员健康检查, 后台探测, 页面读缓存
+ETCD_HEALTH_TTL = int(os.getenv('ETCD_HEALTH_TTL', '10'))
+ETCD_HEALTH_HISTORY = int(os.getenv('ETCD_HEALTH_HISTORY', '30'))
+ETCD_HEALTH_TIMEOUT = int(os.getenv('ETCD_HEALTH_TIMEOUT', '3'))
+# add_host / delete_host 用 prevIndex 做 CAS, 冲突后最多重试几次, 退避基数(秒)
+ETCD_CAS_RETRIES = int(os.getenv('ETCD_CAS_RETRIES', '8'))
+ETCD_CAS_BACKOFF = float(os.getenv('ETCD_CAS_BACKOFF', '0.05'))
+# 批量操作时并发写 etcd 的上限
+ETCD_WRITE_CONCURRENCY = int(os.getenv('ETCD_WRITE_CONCURRENCY', '16'))
+# 一个请求里并发读 etcd 的线程数
+ETCD_READ_CONCURRENCY = int(os.getenv('ETCD_READ_CONCURRENCY', '8'))
+# 目录的子节点数超过一组记录数的这么多倍, 就不读整层改逐个 get
+PREFETCH_DIR_RATIO = int(os.getenv('PREFETCH_DIR_RATIO', '4'))
+# 批量创建一次最多多少条
+API_BULK_MAX = int(os.getenv('API_BULK_MAX', '10000'))
+# 批量读接口一次最多查多少个 id + domain
+API_BATCH_MAX = int(os.getenv('API_BATCH_MAX', '1000'))
+# 打开的话 etcd 的写先记到 etcd_outbox 表里, 由 tools/etcd_publisher.py 异步写出去
+ETCD_OUTBOX = bool(os.getenv('ETCD_OUTBOX', ''))
+ETCD_OUTBOX_BATCH = int(os.getenv('ETCD_OUTBOX_BATCH', '500'))
+ETCD_OUTBOX_INTERVAL = float(os.getenv('ETCD_OUTBOX_INTERVAL', '0.5'))
+# 一个 path 写失败这么多次就挪到 etcd_outbox_dead 里, 不再重试
+ETCD_OUTBOX_MAX_ATTEMPTS = int(os.getenv('ETCD_OUTBOX_MAX_ATTEMPTS', '10'))
+# 列表页总数的缓存时间(秒)
+COUNT_CACHE_TTL = int(os.getenv('COUNT_CACHE_TTL', '60'))
+# session 和 token 鉴权的缓存时间(秒)
+AUTH_CACHE_TTL = int(os.getenv('AUTH_CACHE_TTL', '30'))
+# 转移用户记录时每次 UPDATE 多少条, 多久 (秒) 没进度就当跑它的进程挂了, 让别人接着跑
+TRANSFER_CHUNK = int(os.getenv('TRANSFER_CHUNK', '1000'))
+TRANSFER_STALE = int(os.getenv('TRANSFER_STALE', '60'))
+# 导出接口每次从 MySQL 取多少条
+EXPORT_CHUNK = int(os.getenv('EXPORT_CHUNK', '500'))
+# watch 接口: 每个进程留最近多少个 /skydns 的变化, 一次长轮询最多等多久(秒)
+WATCH_BUFFER = int(os.getenv('WATCH_BUFFER', '10000'))
+WATCH_TIMEOUT = int(os.getenv('WATCH_TIMEOUT', '30'))
+# sync worker 一个请求就占一个 worker, 长轮询最多只等这么久, 也不给 SSE
+WATCH_SYNC_TIMEOUT = int(os.getenv('WATCH_SYNC_TIMEOUT', '0'))
+# /_api 的限流, 每个 token (没有 token 就是 IP) 每秒多少个读/写请求, 最多攒多少个, 默认 0 是不限
+API_READ_RATE = float(os.getenv('API_READ_RATE', '0'))
+API_READ_BURST = int(os.getenv('API_READ_BURST', '100'))
+API_WRITE_RATE = float(os.getenv('API_WRITE_RATE', '0'))
+API_WRITE_BURST = int(os.getenv('API_WRITE_BURST', '20'))
+# 每个进程同时处理的 /_api 请求数, 超过了直接 429, 0 是不限
+API_MAX_INFLIGHT = int(os.getenv('API_MAX_INFLIGHT', '0'))
+# worker 开始接请求之前先做的事, 逗号分隔: etcd, reference, mirror, health, templates
+WARMUP = os.getenv('WARMUP', '')
 SERVER_PORT = int(os.getenv('SERVER_PORT', '5000'))
 
 OAUTH2_CLIENT_ID = os.getenv('OAUTH2_CLIENT_ID', '')
@@ -29,6 +81,7 @@ try:
 except ImportError:
     pass
 
-SQLALCHEMY_DATABASE_URI = 'mysql://{0}:{1}@{2}:{3}/{4}'.format(
-    MYSQL_USER, MYSQL_PASSWORD, MYSQL_HOST, MYSQL_PORT, MYSQL_DATABASE,
+SQLALCHEMY_DATABASE_URI = 'mysql{0}://{1}:{2}@{3}:{4}/{5}'.format(
+    MYSQL_DRIVER and '+' + MYSQL_DRIVER, MYSQL_USER, MYSQL_PASSWORD,
+    MYSQL_HOST, MYSQL_PORT, MYSQL_DATABASE,
 )
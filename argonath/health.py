@@ -0,0 +1,101 @@
+# coding: utf-8
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class HealthMonitor(object):
+    """后台并发探测 etcd 所有成员, 结果缓存 ttl 秒.
+
+    每个成员留最近 history 次的 (时间, 是否健康, 耗时) 记录,
+    页面只读缓存, 缓存太旧 (后台线程挂了) 才会当场探测一次.
+    """
+
+    def __init__(self, client, ttl=10, history=30, timeout=3):
+        self.client = client
+        self.ttl = ttl
+        self.timeout = timeout
+        self.history_size = history
+        self.results = {}
+        self.history = {}
+        self.checked_at = 0
+        self._lock = threading.Lock()
+        self._pid = None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _probe(self, member):
+        nodename, nodeinfo = member
+        rs = {'health': False, 'latency': None, 'url': None}
+        if not nodeinfo['clientURLs']:
+            return nodename, rs
+        url = rs['url'] = nodeinfo['clientURLs'][0]
+        begin = time.time()
+        try:
+            r = self.session.get(url + '/health', timeout=self.timeout)
+            rs['health'] = json.loads(r.content)['health'] in (True, 'true')
+        except Exception:
+            rs['health'] = False
+        rs['latency'] = time.time() - begin
+        return nodename, rs
+
+    def probe(self):
+        members = self.client.members.items()
+        pool = ThreadPool(max(len(members), 1))
+        try:
+            results = dict(pool.map(self._probe, members))
+        finally:
+            pool.close()
+
+        now = time.time()
+        for nodename, rs in results.iteritems():
+            rs['time'] = now
+            h = self.history.setdefault(nodename, deque(maxlen=self.history_size))
+            h.append((now, rs['health'], rs['latency']))
+        self.results = results
+        self.checked_at = now
+        return results
+
+    def _run(self):
+        while True:
+            try:
+                self.probe()
+            except Exception:
+                logger.exception('etcd health probe failed')
+            time.sleep(self.ttl)
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            t = threading.Thread(target=self._run, name='etcd-health')
+            t.daemon = True
+            t.start()
+            self._pid = os.getpid()
+
+    def check(self):
+        """返回 {nodename: {'health', 'latency', 'url', 'time'}}"""
+        self.start()
+        if time.time() - self.checked_at > self.ttl * 2:
+            with self._lock:
+                if time.time() - self.checked_at > self.ttl * 2:
+                    self.probe()
+        return self.results
+
+    def history_of(self, nodename):
+        return list(self.history.get(nodename, ()))
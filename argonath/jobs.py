@@ -0,0 +1,50 @@
+# coding: utf-8
+
+import os
+import logging
+import threading
+
+from argonath.ext import db
+from argonath.models import TransferJob
+
+logger = logging.getLogger(__name__)
+
+
+class JobRunner(object):
+    """在 web 进程里跑 TransferJob 的后台线程.
+
+    kick() 的时候没有线程在跑就起一个, 把能抢到的 job 跑完就退出, 平时不占着.
+    跑 job 的进程挂了的话, job 会停在 running, 过了 stale 秒再有人 kick 就会被接着跑.
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _run(self, app):
+        with app.app_context():
+            try:
+                while True:
+                    job = TransferJob.claim(app.config['TRANSFER_STALE'])
+                    if not job:
+                        return
+                    logger.info('running transfer job %s', job.id)
+                    job.run(app.config['TRANSFER_CHUNK'])
+            except Exception:
+                logger.exception('transfer job runner failed')
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+    def kick(self, app):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, args=(app,), name='transfer-jobs')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+
+runner = JobRunner()
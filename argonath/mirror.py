@@ -0,0 +1,244 @@
+# coding: utf-8
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+import etcd
+
+logger = logging.getLogger(__name__)
+
+
+class EventsExpired(Exception):
+    """要的 index 缓冲区里没有, etcd 的事件历史里也没有了, 调用方要重新全量读"""
+
+
+class _Node(object):
+
+    __slots__ = ('children', 'value', 'index')
+
+    def __init__(self):
+        self.children = {}
+        self.value = None
+        self.index = None
+
+
+class SkydnsMirror(object):
+    """/skydns 在进程内的镜像.
+
+    先递归读一次整棵树, 之后用 waitIndex 一直 watch 着, 按反转的域名存成一棵 trie.
+    watch 的 index 被 etcd 清掉了 (401 event index cleared) 就整棵重新读.
+    modified_index 是最后应用的 modifiedIndex, synced_at 是最后一次确认跟上 etcd 的时间,
+    超过 max_lag 秒没确认过 fresh() 就是 False, 调用方应该回去直接读 etcd.
+
+    最近 buffer_size 个变化留在一个环形缓冲区里, changes() 等着拿, 给 watch 接口用,
+    一个进程里不管多少个客户端都只有这一个 etcd watch.
+    """
+
+    def __init__(self, client, root='/skydns', max_lag=30, watch_timeout=10,
+                 buffer_size=10000):
+        self.client = client
+        self.root = root
+        self.max_lag = max_lag
+        self.watch_timeout = watch_timeout
+        self.modified_index = 0
+        self.synced_at = 0
+        self._tree = _Node()
+        self._lock = threading.Lock()
+        self._pid = None
+        # (modifiedIndex, action, key, value), 比 _floor 新的变化都在里面
+        self._events = deque(maxlen=buffer_size)
+        self._floor = 0
+        self._cond = threading.Condition()
+
+    def _labels(self, key):
+        return [l for l in key[len(self.root):].split('/') if l]
+
+    def _find(self, key):
+        node = self._tree
+        for label in self._labels(key):
+            node = node.children.get(label)
+            if node is None:
+                return None
+        return node
+
+    def _put(self, tree, key, value, index):
+        node = tree
+        for label in self._labels(key):
+            node = node.children.setdefault(label, _Node())
+        node.value = value
+        node.index = index
+
+    def _remove(self, key, dir=False):
+        labels = self._labels(key)
+        if not labels:
+            self._tree = _Node()
+            return
+        parent = self._find(os.path.join(self.root, *labels[:-1]))
+        if parent is None or labels[-1] not in parent.children:
+            return
+        if dir:
+            del parent.children[labels[-1]]
+        else:
+            parent.children[labels[-1]].value = None
+            parent.children[labels[-1]].index = None
+
+    def sync(self):
+        r = self.client.read(self.root, recursive=True)
+        tree = _Node()
+        for node in r.leaves:
+            if not node.dir:
+                self._put(tree, node.key, node.value, node.modifiedIndex)
+        with self._cond:
+            self._tree = tree
+            self.modified_index = r.etcd_index
+            self.synced_at = time.time()
+            # 重新读了整棵树, 中间漏掉的变化没法补, 之前的 index 都作废
+            self._events.clear()
+            self._floor = r.etcd_index
+            self._cond.notify_all()
+        logger.info('skydns mirror synced at index %s', self.modified_index)
+
+    def _apply(self, r):
+        if r.action in ('delete', 'expire', 'compareAndDelete'):
+            self._remove(r.key, dir=r.dir)
+        elif not r.dir:
+            self._put(self._tree, r.key, r.value, r.modifiedIndex)
+        with self._cond:
+            if len(self._events) == self._events.maxlen:
+                self._floor = self._events[0][0]
+            self._events.append((r.modifiedIndex, r.action, r.key, None if r.dir else r.value))
+            self.modified_index = r.modifiedIndex
+            self.synced_at = time.time()
+            self._cond.notify_all()
+
+    def _watch(self):
+        while True:
+            try:
+                if not self.modified_index:
+                    self.sync()
+                r = self.client.read(self.root, recursive=True, wait=True,
+                                     waitIndex=self.modified_index + 1,
+                                     timeout=self.watch_timeout)
+                self._apply(r)
+            except etcd.EtcdWatchTimedOut:
+                # 这段时间里没有变化, 说明现在是跟上的
+                self.synced_at = time.time()
+            except etcd.EtcdEventIndexCleared:
+                logger.warning('skydns mirror index %s cleared, resync', self.modified_index)
+                self.modified_index = 0
+            except Exception:
+                logger.exception('skydns mirror watch failed')
+                time.sleep(1)
+
+    def start(self):
+        """每个进程只起一个 watch 线程, fork 出来的 worker 会自己重新起"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.modified_index = 0
+            self.synced_at = 0
+            self._tree = _Node()
+            self._events.clear()
+            self._floor = 0
+            t = threading.Thread(target=self._watch, name='skydns-mirror')
+            t.daemon = True
+            t.start()
+            self._pid = os.getpid()
+
+    def fresh(self):
+        self.start()
+        return bool(self.modified_index) and time.time() - self.synced_at <= self.max_lag
+
+    def get(self, key):
+        """key 的值, 如果 key 是目录就返回它下面 .self 的值, 没有就是 None"""
+        return self.get_with_index(key)[0]
+
+    def get_with_index(self, key):
+        """(值, modifiedIndex), 没有就是 (None, None)"""
+        node = self._find(key)
+        if node is None:
+            return None, None
+        if node.value is None and '.self' in node.children:
+            node = node.children['.self']
+        return node.value, node.index
+
+    def changes(self, since=None, match=None, timeout=30):
+        """since 之后 match(key) 为真的变化, 返回 ([(index, action, key, value), ...], 新的 index).
+        没有就最多等 timeout 秒, 等不到返回空列表. since 是 None 就从现在开始等.
+        since 比缓冲区还老 (别的 worker 给的 index, 或者这个进程刚重新同步过) 就去 etcd 的事件历史里补,
+        etcd 也没有了才抛 EventsExpired"""
+        self.start()
+        deadline = time.time() + timeout
+        floor = None
+        with self._cond:
+            while True:
+                if not self.modified_index:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        if since is not None:
+                            return [], since
+                        break
+                    self._cond.wait(remaining)
+                    continue
+                if since is None:
+                    since = self.modified_index
+                if since < self._floor:
+                    floor = self._floor
+                    break
+
+                found = []
+                for e in reversed(self._events):
+                    if e[0] <= since:
+                        break
+                    found.append(e)
+                found.reverse()
+                if found:
+                    # 不匹配的也跳过去, 下次不用再看一遍
+                    since = found[-1][0]
+                    found = [e for e in found if match is None or match(e[2])]
+                    if found:
+                        return found, since
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return [], since
+                self._cond.wait(remaining)
+
+        if floor is None:
+            # 还没同步完, 不能给 0, 不然下次从 etcd 的第一个事件开始补; 给 etcd 现在的 index
+            return [], self.client.read(self.root).etcd_index
+        events, since = self._history(since, floor)
+        return [e for e in events if match is None or match(e[2])], since
+
+    def _history(self, since, until, limit=100):
+        """用 waitIndex 一个一个地从 etcd 的事件历史里读 (since, until] 之间的变化, 最多 limit 个.
+        返回 (变化, 读到哪了), etcd 报 event index cleared (401) 抛 EventsExpired"""
+        events = []
+        index = since
+        while index < until and len(events) < limit:
+            try:
+                r = self.client.read(self.root, recursive=True, wait=True,
+                                     waitIndex=index + 1, timeout=self.watch_timeout)
+            except etcd.EtcdEventIndexCleared:
+                raise EventsExpired(since)
+            except etcd.EtcdWatchTimedOut:
+                break
+            if r.modifiedIndex > until:
+                break
+            events.append((r.modifiedIndex, r.action, r.key, None if r.dir else r.value))
+            index = r.modifiedIndex
+        else:
+            return events, index
+        # 到 until 为止都没有别的变化了, 剩下的从缓冲区接着读
+        return events, until
+
+    def status(self):
+        return {
+            'modified_index': self.modified_index,
+            'lag': self.synced_at and time.time() - self.synced_at or None,
+        }
@@ -1,47 +1,370 @@
 # coding: utf-8
 
 import os
+import time
 import etcd
 import json
-import requests
+import random
+import hashlib
+import logging
+import operator
 import datetime
+import threading
 import sqlalchemy.exc
+import sqlalchemy.event
+from multiprocessing.pool import ThreadPool
 
 from etcd import EtcdKeyError
+from flask import g, has_request_context
 from netaddr import IPNetwork, AddrFormatError
+from sqlalchemy import or_, and_
 from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm import make_transient_to_detached
+from werkzeug.local import LocalProxy
 from werkzeug.security import gen_salt
 
 from argonath.ext import db
-from argonath.config import ETCDS, DEFAULT_NET
+from argonath.config import (ETCDS, DEFAULT_NET, ETCD_MIRROR,
+        ETCD_MIRROR_MAX_LAG, ETCD_MIRROR_WATCH_TIMEOUT, ETCD_HEALTH_TTL,
+        ETCD_HEALTH_HISTORY, ETCD_HEALTH_TIMEOUT, ETCD_CAS_RETRIES, ETCD_CAS_BACKOFF,
+        ETCD_WRITE_CONCURRENCY, ETCD_READ_CONCURRENCY, ETCD_OUTBOX, COUNT_CACHE_TTL,
+        PREFETCH_DIR_RATIO, AUTH_CACHE_TTL, TRANSFER_CHUNK, WATCH_BUFFER)
+from argonath.mirror import SkydnsMirror
+from argonath.health import HealthMonitor
+from argonath.cache import TTLCache
+from argonath.resolver import ViewResolver
+from argonath.refdata import VersionedCache, DomainIndex
+
+logger = logging.getLogger(__name__)
 
 
 def _parse_reversed_domain(domain):
     return os.path.join('/skydns', '/'.join(reversed(domain.split('.'))))
 
 
+def _domain_of_path(path):
+    """_parse_reversed_domain 反过来, 结尾的 .self 算它所在目录的"""
+    labels = [l for l in path[len('/skydns'):].split('/') if l]
+    if labels and labels[-1] == '.self':
+        labels.pop()
+    return '.'.join(reversed(labels))
+
+
 def _get_host_port(s):
     h, p = s.split(':')
     return h, int(p)
 
 
 _etcd_machines = [_get_host_port(host) for host in ETCDS.split(',')]
-_etcd = etcd.Client(tuple(_etcd_machines), allow_reconnect=True)
+_etcd_client = {'pid': None, 'client': None}
+_etcd_lock = threading.Lock()
+
+
+def _get_etcd():
+    """第一次用的时候才连 etcd, fork 出来的进程会自己重新建一个, 不和父进程共用连接"""
+    if _etcd_client['pid'] != os.getpid():
+        with _etcd_lock:
+            if _etcd_client['pid'] != os.getpid():
+                _etcd_client['client'] = etcd.Client(tuple(_etcd_machines), allow_reconnect=True)
+                _etcd_client['pid'] = os.getpid()
+    return _etcd_client['client']
+
+
+_etcd = LocalProxy(_get_etcd)
+skydns_mirror = SkydnsMirror(_etcd, max_lag=ETCD_MIRROR_MAX_LAG,
+                             watch_timeout=ETCD_MIRROR_WATCH_TIMEOUT,
+                             buffer_size=WATCH_BUFFER)
+health_monitor = HealthMonitor(_etcd, ttl=ETCD_HEALTH_TTL,
+                               history=ETCD_HEALTH_HISTORY, timeout=ETCD_HEALTH_TIMEOUT)
+
+
+def _use_mirror():
+    return ETCD_MIRROR and skydns_mirror.fresh()
+
+
+def _read_skydns_node(path):
+    """返回 (真正存值的 key, 值, modifiedIndex), path 是目录的话值在 .self 里, 不存在 modifiedIndex 是 None"""
+    key = path
+    try:
+        r = _etcd.get(key)
+        if r.dir:
+            key = os.path.join(path, '.self')
+            r = _etcd.get(key)
+        return key, json.loads(r.value), r.modifiedIndex
+    except (KeyError, EtcdKeyError):
+        return key, {}, None
+
+
+def _read_skydns_value(path):
+    """返回 (值, modifiedIndex), 镜像跟得上就读镜像"""
+    if _use_mirror():
+        v, index = skydns_mirror.get_with_index(path)
+        return (json.loads(v) if v else {}), index
+    return _read_skydns_node(path)[1:]
+
+
+def _hosts_of(data):
+    """{cidr: [{'host': h}, ...]} -> {cidr: [h, ...]}"""
+    if not data:
+        return data
+    return dict([
+        (cidr, [h['host'] for h in hosts]) for cidr, hosts in data.iteritems()
+    ])
+
+
+def watch_skydns(since=None, domain=None, subtree=None, timeout=30):
+    """从镜像的事件缓冲区里等 since 之后的变化, 返回 ([{index, action, domain, host}], 新的 index).
+    domain 只看这一个域名, subtree 看这个域名和它下面所有的, 都不给就是全部.
+    since 太老了抛 mirror.EventsExpired"""
+    match = None
+    if domain:
+        path = _parse_reversed_domain(domain)
+        match = lambda key: key == path or key == path + '/.self'
+    elif subtree:
+        path = _parse_reversed_domain(subtree)
+        match = lambda key: key == path or key.startswith(path + '/')
+
+    events, index = skydns_mirror.changes(since, match, timeout)
+    result = []
+    for i, action, key, value in events:
+        try:
+            data = json.loads(value) if value else None
+        except ValueError:
+            data = None
+        result.append({'index': i, 'action': action, 'domain': _domain_of_path(key),
+                       'host': _hosts_of(data) if isinstance(data, dict) else None})
+    return result, index
+
 
+# 进程内累计的 compare-and-swap 计数, 监控用
+cas_stats = {'writes': 0, 'conflicts': 0, 'retries': 0, 'failures': 0}
 
-def health_check():
-    rs = {}
-    for nodename, nodeinfo in _etcd.members.iteritems():
-        if not nodeinfo['clientURLs']:
-            rs[nodename] = False
+
+def _cas_update(path, update):
+    """用 prevIndex 做 compare-and-swap 改 path 的值, 冲突了就随机退避重试.
+
+    update(data) 原地改或者返回新的 data. 返回 (data, stats), 重试用完了 data 是 None.
+    """
+    stats = {'conflicts': 0, 'retries': 0}
+    for attempt in xrange(ETCD_CAS_RETRIES + 1):
+        if attempt:
+            stats['retries'] += 1
+            time.sleep(random.uniform(0, ETCD_CAS_BACKOFF * 2 ** (attempt - 1)))
+
+        key, data, index = _read_skydns_node(path)
+        data = update(data)
+        try:
+            if index is None:
+                _etcd.write(key, json.dumps(data), prevExist=False)
+            else:
+                _etcd.write(key, json.dumps(data), prevIndex=index)
+        except (etcd.EtcdCompareFailed, etcd.EtcdAlreadyExist,
+                etcd.EtcdNotFile, etcd.EtcdKeyNotFound):
+            # 被别人先改了, 或者 key 刚被 Domain.create 变成了目录
+            stats['conflicts'] += 1
             continue
+        else:
+            break
+    else:
+        data = None
+
+    cas_stats['writes'] += 1
+    cas_stats['conflicts'] += stats['conflicts']
+    cas_stats['retries'] += stats['retries']
+    if data is None:
+        cas_stats['failures'] += 1
+        logger.warning('cas update %s gave up after %s conflicts', path, stats['conflicts'])
+    return data, stats
+
+
+def _add_host(data, cidr, host_or_ip):
+    hosts = data.setdefault(cidr, [])
+    if host_or_ip not in [h['host'] for h in hosts]:
+        hosts.append({'host': host_or_ip})
+    return data
+
+
+def _delete_host(data, cidr, host_or_ip):
+    hosts = [h for h in data.get(cidr, []) if h['host'] != host_or_ip]
+    if hosts:
+        data[cidr] = hosts
+    else:
+        data.pop(cidr, None)
+    return data
+
+
+def _etcd_delete(path):
+    """删一条记录, path 是目录的话值在 .self 里, 删掉 .self 再看目录能不能收掉"""
+    try:
+        _etcd.delete(path)
+    except etcd.EtcdNotFile:
         try:
-            url = nodeinfo['clientURLs'][0]
-            r = requests.get(url + '/health', timeout=3)
-            rs[nodename] = json.loads(r.content)['health']
-        except Exception:
-            rs[nodename] = False
-    return rs
+            _etcd.delete(os.path.join(path, '.self'))
+        except etcd.EtcdKeyNotFound:
+            pass
+        _etcd_rmdir(path)
+    except (KeyError, etcd.EtcdKeyNotFound):
+        pass
+
+
+def _etcd_mkdir(path):
+    """把 path 变成目录, 原来是值的话挪到 .self 里"""
+    try:
+        r = _etcd.read(path)
+    except etcd.EtcdKeyNotFound:
+        _etcd.write(path, None, dir=True)
+        return
+    if r.dir:
+        return
+    #拿到之前的值
+    v = r.value
+    _etcd.delete(path)
+    _etcd.write(os.path.join(path, '.self'), v)
+
+
+def _etcd_rmdir(path):
+    """_etcd_mkdir 反过来: 空目录直接删, 只剩 .self 的话把值挪回 path 上.
+    下面还有别的记录就不动, 不能把人家的记录一起删了. 返回 path 还在不在"""
+    try:
+        r = _etcd.read(path)
+    except etcd.EtcdKeyNotFound:
+        return False
+    if not r.dir:
+        return True
+    children = [n for n in r.leaves if n.key != path]
+    if not children:
+        _etcd.delete(path, dir=True)
+        return False
+    if len(children) == 1 and children[0].key == os.path.join(path, '.self'):
+        v = children[0].value
+        _etcd.delete(children[0].key)
+        _etcd.delete(path, dir=True)
+        _etcd.write(path, v)
+        return True
+    return True
+
+
+_DELETED = object()
+
+
+def _coalesce_ops(ops):
+    """把同一个 path 上按顺序的操作合并, 连续的 set/add_host/delete_host/delete 只剩一次写.
+
+    产出 (action, base, edits): action 是 write/delete/mkdir/rmdir,
+    write 的时候 base 是 None 表示在 etcd 现在的值上改, 否则从 base 开始改, edits 是要依次做的 host 修改.
+    """
+    base, edits, dirty = None, [], False
+    for op, payload in ops:
+        if op in ('mkdir', 'rmdir'):
+            if dirty:
+                yield _flush_ops(base, edits)
+            base, edits, dirty = None, [], False
+            yield op, None, None
+            continue
+        dirty = True
+        if op == 'set':
+            base, edits = payload, []
+        elif op == 'delete':
+            base, edits = _DELETED, []
+        else:
+            edits.append((op, payload))
+    if dirty:
+        yield _flush_ops(base, edits)
+
+
+def _flush_ops(base, edits):
+    if base is _DELETED:
+        if not edits:
+            return 'delete', None, None
+        base = {}
+    return 'write', base, edits
+
+
+def _apply_edits(data, edits):
+    for op, payload in edits:
+        if op == 'add_host':
+            _add_host(data, payload['cidr'], payload['host'])
+        elif op == 'delete_host':
+            _delete_host(data, payload['cidr'], payload['host'])
+    return data
+
+
+def apply_etcd_ops(path, ops):
+    """合并之后把 ops [(op, payload), ...] 写到 etcd, 返回是否都成功了"""
+    try:
+        for action, base, edits in _coalesce_ops(ops):
+            if action == 'delete':
+                _etcd_delete(path)
+            elif action == 'mkdir':
+                _etcd_mkdir(path)
+            elif action == 'rmdir':
+                _etcd_rmdir(path)
+            else:
+                # 重试的时候 update 会被调用好几次, base 不能被改掉
+                start = json.dumps(base) if base is not None else None
+                data, _ = _cas_update(path, lambda d: _apply_edits(
+                    json.loads(start) if start is not None else d, edits))
+                if data is None:
+                    return False
+    except Exception:
+        logger.exception('apply etcd ops on %s failed', path)
+        return False
+    return True
+
+
+def _read_skydns_dir(prefix):
+    """只读一层, 返回 ({key: (value, modifiedIndex)}, 子目录 key 的 set, 子节点个数)"""
+    try:
+        r = _etcd.read(prefix)
+    except (KeyError, EtcdKeyError):
+        return {}, set(), 0
+    children = [n for n in r.leaves if n.key != r.key]
+    files = dict((n.key, (n.value, n.modifiedIndex)) for n in children if not n.dir)
+    dirs = set(n.key for n in children if n.dir)
+    return files, dirs, len(children)
+
+
+def _etcd_set_many(items):
+    """最多 ETCD_WRITE_CONCURRENCY 个并发写 [(key, value), ...], 返回对应的异常, 成功是 None"""
+    def _set(item):
+        try:
+            _etcd.set(*item)
+        except Exception as e:
+            logger.warning('etcd set %s failed: %s', item[0], e)
+            return e
+
+    if not items:
+        return []
+    pool = ThreadPool(min(ETCD_WRITE_CONCURRENCY, len(items)))
+    try:
+        return pool.map(_set, items)
+    finally:
+        pool.close()
+
+
+def _escape_like(s):
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _chunks(seq, size):
+    for i in xrange(0, len(seq), size):
+        yield seq[i:i+size]
+
+
+# 列表页的总数, 本进程里增删的时候顺手加减, 别的进程的改动最多晚 COUNT_CACHE_TTL 秒
+_counts = TTLCache(COUNT_CACHE_TTL)
+# 搜索的总数按用户给的 pattern 缓存, 单独放, 满了清掉也不影响列表页的总数
+_search_counts = TTLCache(COUNT_CACHE_TTL, maxsize=1000)
+
+# 登录和 token 鉴权用, 存的是 User 的列, 别的进程改了用户最多晚 AUTH_CACHE_TTL 秒
+_auth_cache = TTLCache(AUTH_CACHE_TTL)
+# 目录下有多少子节点, 用来判断整层读值不值
+_dir_sizes = TTLCache(300, maxsize=10000)
+
+
+def _wants(fields, key):
+    return fields is None or key in fields
 
 
 class Base(db.Model):
@@ -54,15 +377,80 @@ class Base(db.Model):
 
     @classmethod
     def get(cls, id):
-        return cls.query.filter(cls.id == id).first()
+        """本次请求已经加载过的直接从 session 的 identity map 里拿"""
+        return cls.query.get(id)
 
     @classmethod
     def get_multi(cls, ids):
-        return [cls.get(i) for i in ids]
+        """按 ids 的顺序返回, 没有的是 None. session 里已经有的不再查, 剩下的一条 IN 查询"""
+        ids = list(ids)
+        found = {}
+        for i in set(ids):
+            obj = db.session.identity_map.get(identity_key(cls, i))
+            if obj is not None:
+                found[i] = obj
+        missing = [i for i in set(ids) if i not in found]
+        if missing:
+            found.update((r.id, r) for r in cls.query.filter(cls.id.in_(missing)))
+        return [found.get(i) for i in ids]
+
+    @classmethod
+    def _count(cls, q, key, cache=_counts):
+        total = cache.get(key)
+        if total is None:
+            total = q.count()
+            cache.set(key, total)
+        return total
+
+    @classmethod
+    def _page(cls, q, start=0, limit=20, before=None):
+        """按 id 倒序翻页, 给了 before 就用 id < before 定位, 不用 OFFSET"""
+        q = q.order_by(cls.id.desc())
+        if before:
+            q = q.filter(cls.id < before)
+        else:
+            q = q.offset(start)
+        if limit is not None:
+            q = q.limit(limit)
+        return q.all()
+
+    @classmethod
+    def iter_chunks(cls, size=1000, query=None):
+        """按 id 从小到大一块一块地取, 用 id > last 翻页而不是 OFFSET"""
+        q = cls.query if query is None else query
+        last = 0
+        while True:
+            rows = q.filter(cls.id > last).order_by(cls.id).limit(size).all()
+            if not rows:
+                return
+            last = rows[-1].id
+            yield rows
 
-    def to_dict(self):
-        keys = [c.key for c in self.__table__.columns]
-        return {k: getattr(self, k) for k in keys}
+    @classmethod
+    def _serializer(cls, fields=None):
+        """(列名, 一次取出这些列的 attrgetter), 每个 model 每种 fields 只编一次"""
+        if '_serializers' not in cls.__dict__:
+            cls._serializers = {}
+        s = cls._serializers.get(fields)
+        if s is None:
+            # 只按真的列缓存, 乱传的字段不会把缓存撑大
+            keys = tuple(c.key for c in cls.__table__.columns if _wants(fields, c.key))
+            s = cls._serializers.get(frozenset(keys))
+            if s is None:
+                if len(keys) > 1:
+                    getter = operator.attrgetter(*keys)
+                else:
+                    getter = lambda obj, keys=keys: tuple(getattr(obj, k) for k in keys)
+                s = (keys, getter)
+                cls._serializers[frozenset(keys)] = s
+                if fields is None or fields == frozenset(keys):
+                    cls._serializers[fields] = s
+        return s
+
+    def to_dict(self, fields=None):
+        """fields 是要的字段的 frozenset, None 是全要"""
+        keys, getter = self._serializer(fields)
+        return dict(zip(keys, getter(self)))
 
     def __repr__(self):
         attrs = ', '.join('{0}={1}'.format(k, v) for k, v in self.to_dict().iteritems())
@@ -72,134 +460,376 @@ class Base(db.Model):
 class Record(Base):
 
     __tablename__ = 'record'
-    name = db.Column(db.String(255), nullable=False, default='')
+    name = db.Column(db.String(255), index=True, nullable=False, default='')
     domain = db.Column(db.String(255), unique=True, nullable=False, default='')
+    # 和 Domain.reversed_path 一样, 用来按后缀/子树查
+    reversed_path = db.Column(db.String(255), index=True, nullable=False, default='')
     time = db.Column(db.DateTime, default=datetime.datetime.now)
+    updated = db.Column(db.DateTime, default=datetime.datetime.now,
+            onupdate=datetime.datetime.now)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # 老的备注, 已经挪到 record_host 里了, 只留给 tools/migrate_db.py 迁移用
     comments = db.Column(db.Text, default='{}')
+    host_rows = db.relationship('RecordHost', backref='record', lazy='dynamic',
+                                cascade='all, delete-orphan')
 
     def __init__(self, name, domain):
         self.name = name
         self.domain = domain
+        self.reversed_path = _parse_reversed_domain(domain)
 
     @classmethod
     def create(cls, user, name, domain, host_or_ip, comment=''):
         """目前只支持A记录和CNAME"""
+        data = {DEFAULT_NET: [{'host': host_or_ip}]}
         try:
             r = cls(name, domain)
+            RecordHost(r, DEFAULT_NET, host_or_ip, comment)
             user.records.append(r)
             db.session.add(r)
+            if ETCD_OUTBOX:
+                db.session.add(EtcdOutbox(r.skydns_path, 'set', data))
             db.session.commit()
         except sqlalchemy.exc.IntegrityError:
             db.session.rollback()
             return None
         else:
-            data = json.dumps({DEFAULT_NET: [{'host': host_or_ip}]})
+            if not ETCD_OUTBOX:
+                _etcd.set(r.skydns_path, json.dumps(data))
+            r._skydns_data = data
+            _counts.incr('record')
+            _counts.incr(('record', user.id))
+            return r
 
-            _etcd.set(r.skydns_path, data)
-            r.set_comment(host_or_ip, comment)
+    @classmethod
+    def bulk_create(cls, user, items):
+        """items 是校验过的 [(name, domain, host_or_ip, comment), ...],
+        所有行在一个事务里插入, etcd 并发写.
+        返回和 items 一一对应的 {'domain', 'id', 'r', 'message'}"""
+        domains = [domain for _, domain, _, _ in items]
+        existing = set()
+        for chunk in _chunks(domains, 1000):
+            existing.update(d for d, in db.session.query(cls.domain).filter(cls.domain.in_(chunk)))
+
+        results, created = [], []
+        for name, domain, host_or_ip, comment in items:
+            rs = {'domain': domain, 'id': None, 'r': 1, 'message': u'记录已经存在'}
+            results.append(rs)
+            if domain in existing:
+                continue
+            existing.add(domain)
+            r = cls(name, domain)
+            r.user_id = user.id
+            RecordHost(r, DEFAULT_NET, host_or_ip, comment)
+            created.append((rs, r, json.dumps({DEFAULT_NET: [{'host': host_or_ip}]})))
 
-            return r
+        try:
+            db.session.add_all([rec for _, rec, _ in created])
+            if ETCD_OUTBOX:
+                db.session.add_all([EtcdOutbox(rec.skydns_path, 'set', json.loads(value))
+                                    for _, rec, value in created])
+            db.session.flush()
+            # commit 之后再碰 record 会一条条重新 SELECT, 所以先把要的东西拿出来
+            writes = [(res, rec.id, rec.skydns_path, value) for res, rec, value in created]
+            db.session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # 校验完到提交之间被别人抢先建了, 整批都算失败, 让调用方重试
+            db.session.rollback()
+            for rs, _, _ in created:
+                rs['message'] = u'创建失败, 请重试'
+            return results
+
+        _counts.incr('record', len(writes))
+        _counts.incr(('record', user.id), len(writes))
+        if ETCD_OUTBOX:
+            errors = [None] * len(writes)
+        else:
+            errors = _etcd_set_many([(path, value) for _, _, path, value in writes])
+        for (rs, rid, _, _), e in zip(writes, errors):
+            rs.update(id=rid, r=1 if e else 0, message=u'写 etcd 失败' if e else 'ok')
+        return results
 
     @classmethod
     def get_by_name(cls, name):
         return cls.query.filter(cls.name == name).first()
 
+    @classmethod
+    def get_batch(cls, ids=(), domains=()):
+        """按 id 和 domain 一起一条 IN 查询, 返回 ({id: record}, {domain: record}), 没有的不在里面"""
+        ids, domains = set(ids), set(domains)
+        conds = []
+        if ids:
+            conds.append(cls.id.in_(ids))
+        if domains:
+            conds.append(cls.domain.in_(domains))
+        if not conds:
+            return {}, {}
+        rows = cls.query.filter(or_(*conds)).all()
+        return (dict((r.id, r) for r in rows if r.id in ids),
+                dict((r.domain, r) for r in rows if r.domain in domains))
+
     @classmethod
     def get_by_domain(cls, domain):
         return cls.query.filter(cls.domain == domain).first()
 
     @classmethod
-    def list_records(cls, start=0, limit=20):
+    def _search_query(cls, pattern):
+        """pattern 里 * 匹配任意字符 (包括 "."), ? 匹配一个字符.
+        结尾不带通配符的那几段 label 先用 reversed_path 的前缀走索引缩小范围,
+        剩下的用 domain LIKE; 没有通配符就是 name 或者 domain 精确匹配."""
+        if '*' not in pattern and '?' not in pattern:
+            return cls.query.filter(db.or_(cls.name == pattern, cls.domain == pattern))
+
+        q = cls.query
+        labels = pattern.split('.')
+        suffix = []
+        while len(labels) > 1 and '*' not in labels[-1] and '?' not in labels[-1]:
+            suffix.insert(0, labels.pop())
+        if suffix:
+            prefix = _parse_reversed_domain('.'.join(suffix)) + '/'
+            q = q.filter(cls.reversed_path.like(_escape_like(prefix) + '%', escape='\\'))
+        if labels != ['*']:
+            like = _escape_like(pattern).replace('*', '%').replace('?', '_')
+            q = q.filter(cls.domain.like(like, escape='\\'))
+        return q
+
+    @classmethod
+    def search(cls, pattern, start=0, limit=20, before=None):
         """还会返回总数"""
-        q = cls.query.order_by(cls.id.desc())
-        total = q.count()
-        q = q.offset(start)
-        if limit is not None:
-            q = q.limit(limit)
-        return q.all(), total
+        q = cls._search_query(pattern)
+        return (cls._page(q.options(db.joinedload(cls.user)), start, limit, before),
+                cls._count(q, pattern, _search_counts))
+
+    @classmethod
+    def list_records(cls, start=0, limit=20, before=None):
+        """还会返回总数"""
+        q = cls.query.options(db.joinedload(cls.user))
+        return cls._page(q, start, limit, before), cls._count(cls.query, 'record')
 
     @property
     def skydns_path(self):
         return _parse_reversed_domain(self.domain)
 
+    @classmethod
+    def prefetch_hosts(cls, records):
+        """按父目录分组, 目录不比这一组大太多就只读一层, 否则逐个 get, 全部并发, 结果记在 record 上, 本次请求内复用"""
+        if _use_mirror():
+            return records
+
+        groups = {}
+        for r in records:
+            if r is None or '_skydns_data' in r.__dict__:
+                continue
+            groups.setdefault(os.path.dirname(r.skydns_path), []).append(r)
+
+        tasks = []
+        for prefix, rs in groups.iteritems():
+            size = _dir_sizes.get(prefix)
+            # 就一个, 或者目录比这一组大很多 (比如 svc.ricebook 下几千个), 逐个 get 更便宜
+            if len(rs) < 2 or (size is not None and size > len(rs) * PREFETCH_DIR_RATIO):
+                tasks.extend((None, [r]) for r in rs)
+            else:
+                tasks.append((prefix, rs))
+
+        def _load(task):
+            prefix, rs = task
+            if prefix is None:
+                rs[0]._load_skydns()
+                return
+            files, dirs, size = _read_skydns_dir(prefix)
+            _dir_sizes.set(prefix, size)
+            for r in rs:
+                # 自己是目录的话值在 .self 里, 这一层读不到, 单独 get
+                if r.skydns_path in dirs:
+                    r._load_skydns()
+                    continue
+                v, index = files.get(r.skydns_path, (None, None))
+                r._skydns_data = json.loads(v) if v else {}
+                r._skydns_index = index
+
+        if len(tasks) < 2:
+            map(_load, tasks)
+            return records
+        pool = ThreadPool(min(ETCD_READ_CONCURRENCY, len(tasks)))
+        try:
+            pool.map(_load, tasks)
+        finally:
+            pool.close()
+        return records
+
+    def _load_skydns(self):
+        self._skydns_data, self._skydns_index = _read_skydns_value(self.skydns_path)
+
     @property
     def skydns_data(self):
-        try:
-            r = _etcd.get(self.skydns_path)
-            if r.dir:
-                r = _etcd.get(os.path.join(self.skydns_path, '.self'))
-            return json.loads(r.value)
-        except (KeyError, EtcdKeyError):
-            return {}
+        if '_skydns_data' not in self.__dict__:
+            self._load_skydns()
+        return self._skydns_data
 
     @property
-    def hosts(self):
-        data = self.skydns_data
-        if not data:
-            return data
-        return dict([
-            (cidr, [h['host'] for h in hosts]) for cidr, hosts in data.iteritems()
-        ])
+    def skydns_index(self):
+        """etcd 里这条记录的 modifiedIndex, 没有是 None"""
+        if '_skydns_index' not in self.__dict__:
+            self._load_skydns()
+        return self._skydns_index
+
+    def etag(self, hosts=True, comments=True):
+        """行的版本加上 etcd 的 modifiedIndex, 两边都没变就不变. 不要 host 就不读 etcd.
+        备注在 record_host 里, 改了不动 updated, 要备注的话把备注的摘要也算进去"""
+        updated = self.updated and self.updated.strftime('%Y%m%d%H%M%S') or 0
+        index = hosts and self.skydns_index or 0
+        tag = '%s-%s-%s-%s' % (self.id, self.user_id, updated, index)
+        if comments:
+            tag += '-' + hashlib.md5(json.dumps(self.get_comments(), sort_keys=True)).hexdigest()[:8]
+        return tag
 
-    def get_comments(self):
-        return json.loads(self.comments)
+    @classmethod
+    def list_etag(cls, records, total, hosts=True, comments=True):
+        tags = [r.etag(hosts, comments) for r in records]
+        return hashlib.md5(' '.join([str(total)] + tags)).hexdigest()
 
-    def set_comment(self, host_or_ip, comment=''):
-        comments = self.get_comments()
-        comments[host_or_ip] = comment
-        self.comments = json.dumps(comments)
-        db.session.add(self)
-        db.session.commit()
+    @property
+    def hosts(self):
+        return _hosts_of(self.skydns_data)
 
-    def delete_comment(self, host_or_ip):
-        comments = self.get_comments()
-        comments.pop(host_or_ip, None)
-        self.comments = json.dumps(comments)
-        db.session.add(self)
-        db.session.commit()
+    @classmethod
+    def prefetch_comments(cls, records):
+        """一条查询读出一页记录的备注, 记在 record 上, 省得每条记录查一次"""
+        records = [r for r in records if r is not None and '_comments' not in r.__dict__]
+        if not records:
+            return
+        comments = dict((r.id, {}) for r in records)
+        rows = db.session.query(RecordHost.record_id, RecordHost.host, RecordHost.comment).filter(
+                RecordHost.record_id.in_(comments.keys()))
+        for record_id, host, comment in rows:
+            comments[record_id][host] = comment
+        for r in records:
+            r._comments = comments[r.id]
 
-    def _parse_data(self, data):
-        return dict([
-            (cidr, [{'host': h} for h in hosts]) for cidr, hosts in data.iteritems()
-        ])
+    def get_comments(self):
+        """{host: 备注}"""
+        if '_comments' not in self.__dict__:
+            self._comments = dict((h.host, h.comment) for h in self.host_rows)
+        return self._comments
+
+    def _save_host_row(self, cidr, host_or_ip, comment=''):
+        self.__dict__.pop('_comments', None)
+        row = self.host_rows.filter_by(cidr=cidr, host=host_or_ip).first()
+        if row is None:
+            row = RecordHost(self, cidr, host_or_ip)
+        row.comment = comment
+        db.session.add(row)
+
+    def _delete_host_row(self, cidr, host_or_ip):
+        self.__dict__.pop('_comments', None)
+        self.host_rows.filter_by(cidr=cidr, host=host_or_ip).delete(synchronize_session=False)
+
+    def _commit_host_rows(self):
+        try:
+            db.session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # 别人同时加了同一个 host, 行已经在了
+            db.session.rollback()
 
-    def add_host(self, cidr, host_or_ip, comment=''):
-        data = self.hosts
-        if not data.get(cidr):
-            data[cidr] = [host_or_ip, ]
-        elif host_or_ip not in data[cidr]:
-            data[cidr].append(host_or_ip)
+    def _enqueue(self, op, payload=None):
+        """和调用方的改动同一个事务提交, publisher 之后再写 etcd, 本地记的值就作废了"""
+        db.session.add(EtcdOutbox(self.skydns_path, op, payload))
+        self.__dict__.pop('_skydns_data', None)
+        self.__dict__.pop('_skydns_index', None)
 
-        _etcd.set(self.skydns_path, json.dumps(self._parse_data(data)))
-        self.set_comment(host_or_ip, comment)
+    def add_host(self, cidr, host_or_ip, comment=''):
+        """并发安全, 返回 {'ok', 'conflicts', 'retries'}"""
+        if ETCD_OUTBOX:
+            self._save_host_row(cidr, host_or_ip, comment)
+            self._enqueue('add_host', {'cidr': cidr, 'host': host_or_ip})
+            db.session.commit()
+            return {'ok': True, 'conflicts': 0, 'retries': 0, 'queued': True}
+
+        data, stats = _cas_update(self.skydns_path,
+                lambda data: _add_host(data, cidr, host_or_ip))
+        if data is None:
+            return dict(stats, ok=False)
+        self._skydns_data = data
+        self.__dict__.pop('_skydns_index', None)
+        self._save_host_row(cidr, host_or_ip, comment)
+        self._commit_host_rows()
+        return dict(stats, ok=True)
 
     def delete_host(self, cidr, host_or_ip):
-        data = self.hosts
-        if not data[cidr]:
-            del data[cidr]
-        else:
-            data[cidr] = [x for x in data[cidr] if x != host_or_ip]
-
-        _etcd.set(self.skydns_path, json.dumps(self._parse_data(data)))
-        self.delete_comment(host_or_ip)
+        """并发安全, 返回 {'ok', 'conflicts', 'retries'}"""
+        if ETCD_OUTBOX:
+            self._delete_host_row(cidr, host_or_ip)
+            self._enqueue('delete_host', {'cidr': cidr, 'host': host_or_ip})
+            db.session.commit()
+            return {'ok': True, 'conflicts': 0, 'retries': 0, 'queued': True}
+
+        data, stats = _cas_update(self.skydns_path,
+                lambda data: _delete_host(data, cidr, host_or_ip))
+        if data is None:
+            return dict(stats, ok=False)
+        self._skydns_data = data
+        self.__dict__.pop('_skydns_index', None)
+        self._delete_host_row(cidr, host_or_ip)
+        self._commit_host_rows()
+        return dict(stats, ok=True)
 
     def can_do(self, user):
         return user and (self.user_id == user.id or user.is_admin())
 
     def delete(self):
+        user_id = self.user_id
         try:
             db.session.delete(self)
+            if ETCD_OUTBOX:
+                self._enqueue('delete')
             db.session.commit()
         except Exception:
             db.session.rollback()
             return
         else:
-            _etcd.delete(self.skydns_path)
+            if not ETCD_OUTBOX:
+                _etcd_delete(self.skydns_path)
+            self._skydns_data = {}
+            _counts.incr('record', -1)
+            _counts.incr(('record', user_id), -1)
+
+    def to_dict(self, fields=None):
+        d = super(Record, self).to_dict(fields)
+        # 老的 comments 列已经不维护了, 输出的还是原来的 JSON 字符串, 内容从 record_host 来
+        if _wants(fields, 'comments'):
+            d['comments'] = json.dumps(self.get_comments())
+        if _wants(fields, 'host'):
+            d['host'] = self.hosts
+        return d
+
+
+class RecordHost(Base):
+    """etcd 里每个 host 在 MySQL 里的一份, 带着备注, 按 host 建了索引用来反查"""
+
+    __tablename__ = 'record_host'
+    __table_args__ = (db.UniqueConstraint('record_id', 'cidr', 'host'), )
+
+    record_id = db.Column(db.Integer, db.ForeignKey('record.id'), nullable=False)
+    cidr = db.Column(db.String(255), nullable=False)
+    host = db.Column(db.String(255), index=True, nullable=False)
+    # 老的备注是随便写的, 不限长度
+    comment = db.Column(db.Text, nullable=False, default='')
+
+    def __init__(self, record, cidr, host, comment=''):
+        self.record = record
+        self.cidr = cidr
+        self.host = host
+        self.comment = comment
 
-    def to_dict(self):
-        d = super(Record, self).to_dict()
-        d['host'] = self.hosts
+    @classmethod
+    def find_by_host(cls, host, limit=100):
+        return cls.query.filter(cls.host == host).options(
+                db.joinedload(cls.record)).order_by(cls.id).limit(limit).all()
+
+    def to_dict(self, fields=None):
+        d = super(RecordHost, self).to_dict(fields)
+        if _wants(fields, 'domain'):
+            d['domain'] = self.record.domain
         return d
 
 
@@ -243,38 +873,67 @@ class User(Base):
     def get_by_token(cls, token):
         return cls.query.filter(cls.token == token).first()
 
+    @classmethod
+    def _get_for_auth(cls, key, load):
+        """缓存里有就直接拼一个 User merge 到 session 里, 不查库"""
+        d = _auth_cache.get(key)
+        if d is None:
+            u = load()
+            if u is not None:
+                d = dict((c.key, getattr(u, c.key)) for c in cls.__table__.columns)
+                _auth_cache.set(('id', u.id), d)
+                _auth_cache.set(('token', u.token), d)
+            return u
+
+        u = cls(d['name'], d['email'], d['token'])
+        for k, v in d.iteritems():
+            setattr(u, k, v)
+        make_transient_to_detached(u)
+        return db.session.merge(u, load=False)
+
+    @classmethod
+    def get_cached(cls, id):
+        return cls._get_for_auth(('id', id), lambda: cls.get(id))
+
+    @classmethod
+    def get_by_token_cached(cls, token):
+        return cls._get_for_auth(('token', token), lambda: cls.get_by_token(token))
+
     @classmethod
     def list_users(cls, start=0, limit=20):
         return cls.query.offset(start).limit(limit).all()
 
     @classmethod
     def transfer(cls, source_user, target_user):
-        target_user.records.extend(source_user.records)
-        source_user.records.delete()
-        db.session.add(target_user)
-        db.session.add(source_user)
-        db.session.commit()
+        """只是建一个 TransferJob, 真正的 UPDATE 在后台跑, 见 argonath.jobs"""
+        return TransferJob.create(source_user, target_user)
 
-    def list_records(self, start=0, limit=20):
+    def list_records(self, start=0, limit=20, before=None):
         """还会返回总数"""
-        q = self.records.order_by(Record.id.desc())
-        total = q.count()
-        q = q.offset(start)
-        if limit is not None:
-            q = q.limit(limit)
-        return q.all(), total
+        return (Record._page(self.records, start, limit, before),
+                Record._count(self.records, ('record', self.id)))
 
     def is_admin(self):
         """-_-!"""
         return self.admin
 
-    def to_dict(self):
-        d = super(User, self).to_dict()
+    def to_dict(self, fields=None):
+        d = super(User, self).to_dict(fields)
         d.pop('token', None)
-        d['is_admin'] = self.is_admin()
+        if _wants(fields, 'is_admin'):
+            d['is_admin'] = self.is_admin()
         return d
 
 
+@sqlalchemy.event.listens_for(User, 'after_update')
+@sqlalchemy.event.listens_for(User, 'after_delete')
+def _invalidate_auth_cache(mapper, connection, target):
+    _auth_cache.delete(('id', target.id))
+    _auth_cache.delete(('token', target.token))
+    for token in sqlalchemy.inspect(target).attrs.token.history.deleted:
+        _auth_cache.delete(('token', token))
+
+
 class CIDR(Base):
     __tablename__ = "cidr"
     name = db.Column(db.String(255), unique=True, nullable=False)
@@ -295,20 +954,31 @@ class CIDR(Base):
         try:
             c = cls(name, str(net))
             db.session.add(c)
+            RefVersion.bump('cidr')
             db.session.commit()
+            _counts.incr('cidr')
+            reference.invalidate('cidr')
             return c
         except sqlalchemy.exc.IntegrityError:
             db.session.rollback()
             return None
 
+    @classmethod
+    def get_all(cls):
+        """缓存着的 [(name, cidr), ...], 可以用 .name .cidr 取"""
+        return reference.get('cidr').cidrs
+
+    @classmethod
+    def resolver(cls):
+        return reference.get('cidr')
+
     @classmethod
     def get_by_name(cls, name):
         return cls.query.filter(cls.name == name).first()
 
     @classmethod
-    def list_cidrs(cls, start=0, limit=20):
-        q = cls.query.order_by(cls.id.desc())
-        return q[start:start+limit], q.count()
+    def list_cidrs(cls, start=0, limit=20, before=None):
+        return cls._page(cls.query, start, limit, before), cls._count(cls.query, 'cidr')
 
     def is_default(self):
         return self.name == DEFAULT_NET
@@ -322,15 +992,20 @@ class CIDR(Base):
             self.name = name
             self.cidr = cidr
             db.session.add(self)
+            RefVersion.bump('cidr')
             db.session.commit()
-            return self
         except sqlalchemy.exc.IntegrityError:
             db.session.rollback()
             return None
+        reference.invalidate('cidr')
+        return self
 
     def delete(self):
         db.session.delete(self)
+        RefVersion.bump('cidr')
         db.session.commit()
+        _counts.incr('cidr', -1)
+        reference.invalidate('cidr')
 
 
 class Domain(Base):
@@ -348,67 +1023,253 @@ class Domain(Base):
         try:
             d = cls(domain)
             db.session.add(d)
+            RefVersion.bump('domain')
+            if ETCD_OUTBOX:
+                db.session.add(EtcdOutbox(d.reversed_path, 'mkdir'))
             db.session.commit()
         except sqlalchemy.exc.IntegrityError:
             db.session.rollback()
             return None
         else:
-            try:
-                r = _etcd.read(d.reversed_path)
-            except etcd.EtcdKeyNotFound:
-                _etcd.write(d.reversed_path, None, dir=True)
-                return d
-            else:
-                if r.dir:
-                    return d
-                #拿到之前的值
-                v = r.value
-                _etcd.delete(d.reversed_path)
-                _etcd.write(os.path.join(d.reversed_path, '.self'), v)
-                return d
+            if not ETCD_OUTBOX:
+                _etcd_mkdir(d.reversed_path)
+            _counts.incr('domain')
+            reference.invalidate('domain')
+            return d
 
     @classmethod
     def get_by_name(cls, domain):
         return cls.query.filter(cls.domain == domain).first()
 
     @classmethod
-    def list_domains(cls, start=0, limit=20):
-        q = cls.query.order_by(cls.id.desc())
-        return q[start:start+limit], q.count()
+    def index(cls):
+        return reference.get('domain')
+
+    @classmethod
+    def existing(cls, domains):
+        """domains 里哪些存在, 查的是缓存的后缀树"""
+        index = cls.index()
+        return set(d for d in domains if d in index)
+
+    @classmethod
+    def list_domains(cls, start=0, limit=20, before=None):
+        return cls._page(cls.query, start, limit, before), cls._count(cls.query, 'domain')
 
     @classmethod
     def get_all(cls):
-        return [item.domain for item in cls.query.all()]
+        return cls.index().domains
 
     def edit(self, domain):
         try:
             self.domain = domain
             self.reversed_path = _parse_reversed_domain(domain)
             db.session.add(self)
+            RefVersion.bump('domain')
             db.session.commit()
-            return self
         except sqlalchemy.exc.IntegrityError:
             db.session.rollback()
             return None
+        reference.invalidate('domain')
+        return self
 
     def delete(self):
         try:
             db.session.delete(self)
+            RefVersion.bump('domain')
+            if ETCD_OUTBOX:
+                db.session.add(EtcdOutbox(self.reversed_path, 'rmdir'))
             db.session.commit()
-            return True
         except Exception:
             db.session.rollback()
             return False
-        else:
-            try:
-                r = _etcd.read(self.reversed_path)
-                if r.dir:
-                    _etcd.delete(self.reversed_path, recursive=True, dir=True)
-                else:
-                    _etcd.delete(self.reversed_path)
-            except etcd.EtcdKeyNotFound:
-                return True
-            except Exception:
-                return False
-            else:
-                return True
+        _counts.incr('domain', -1)
+        reference.invalidate('domain')
+        if ETCD_OUTBOX:
+            return True
+        try:
+            _etcd_rmdir(self.reversed_path)
+        except Exception:
+            logger.exception('remove etcd dir %s failed', self.reversed_path)
+            return False
+        return True
+
+
+class RefVersion(Base):
+    """Domain / CIDR 这种参考数据的版本号, 改表的时候在同一个事务里加一"""
+    __tablename__ = "ref_version"
+
+    name = db.Column(db.String(64), unique=True, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, name, version=0):
+        self.name = name
+        self.version = version
+
+    @classmethod
+    def bump(cls, name):
+        n = cls.query.filter(cls.name == name).update(
+                {cls.version: cls.version + 1}, synchronize_session=False)
+        if not n:
+            db.session.add(cls(name, 1))
+
+    @classmethod
+    def current(cls):
+        """{name: version}, 一个请求里只查一次"""
+        if not has_request_context():
+            return dict(db.session.query(cls.name, cls.version))
+        versions = getattr(g, '_ref_versions', None)
+        if versions is None:
+            versions = g._ref_versions = dict(db.session.query(cls.name, cls.version))
+        return versions
+
+
+reference = VersionedCache(RefVersion.current,
+        domain=lambda: DomainIndex(d for d, in db.session.query(Domain.domain)),
+        cidr=lambda: ViewResolver(db.session.query(CIDR.name, CIDR.cidr).order_by(CIDR.id)))
+
+
+class TransferJob(Base):
+    """把 source 的记录都转给 target, 后台按 id 一块一块地 UPDATE, 每块一个事务"""
+    __tablename__ = "transfer_job"
+
+    source_id = db.Column(db.Integer, nullable=False)
+    target_id = db.Column(db.Integer, nullable=False)
+    # pending / running / done / failed
+    status = db.Column(db.String(16), nullable=False, default='pending', index=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    moved = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(255), nullable=False, default='')
+    time = db.Column(db.DateTime, default=datetime.datetime.now)
+    updated = db.Column(db.DateTime, default=datetime.datetime.now)
+
+    def __init__(self, source_id, target_id, total):
+        self.source_id = source_id
+        self.target_id = target_id
+        self.total = total
+        self.status = 'pending'
+        self.moved = 0
+        self.error = ''
+        self.updated = datetime.datetime.now()
+
+    @classmethod
+    def create(cls, source_user, target_user):
+        total = db.session.query(db.func.count(Record.id)).filter(
+                Record.user_id == source_user.id).scalar()
+        job = cls(source_user.id, target_user.id, total)
+        db.session.add(job)
+        db.session.commit()
+        return job
+
+    @classmethod
+    def claim(cls, stale=60):
+        """抢一个要跑的 job: pending 的, 或者 running 但是 stale 秒没有进度的.
+        用带条件的 UPDATE 抢, 几个进程同时抢只有一个能成"""
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=stale)
+        job = cls.query.filter(or_(cls.status == 'pending',
+                and_(cls.status == 'running', cls.updated < cutoff))).order_by(cls.id).first()
+        if not job:
+            return None
+        n = cls.query.filter(cls.id == job.id, cls.status == job.status,
+                cls.updated == job.updated).update(
+                {cls.status: 'running', cls.updated: datetime.datetime.now()},
+                synchronize_session=False)
+        db.session.commit()
+        if not n:
+            return None
+        db.session.refresh(job)
+        return job
+
+    def run(self, chunk=TRANSFER_CHUNK):
+        """UPDATE record SET user_id = target WHERE id IN (这一块), 内存里只有一块 id.
+        中途挂了再跑一次也没关系, 已经转过去的不会再被选到"""
+        t = Record.__table__
+        last = 0
+        try:
+            while True:
+                ids = [i for i, in db.session.query(Record.id).filter(
+                        Record.user_id == self.source_id, Record.id > last
+                        ).order_by(Record.id).limit(chunk)]
+                if not ids:
+                    break
+                last = ids[-1]
+                r = db.session.execute(t.update().where(t.c.id.in_(ids)).where(
+                        t.c.user_id == self.source_id).values(user_id=self.target_id))
+                self.moved += r.rowcount
+                self.updated = datetime.datetime.now()
+                db.session.commit()
+            self.status = 'done'
+        except Exception as e:
+            db.session.rollback()
+            self.status = 'failed'
+            self.error = str(e)[:255]
+            logger.exception('transfer job %s failed', self.id)
+        self.updated = datetime.datetime.now()
+        db.session.commit()
+        _counts.delete(('record', self.source_id))
+        _counts.delete(('record', self.target_id))
+        return self.status == 'done'
+
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def to_dict(self, fields=None):
+        d = super(TransferJob, self).to_dict(fields)
+        if _wants(fields, 'finished'):
+            d['finished'] = self.finished()
+        return d
+
+
+class EtcdOutbox(Base):
+    """要写到 etcd 的操作, 和 model 的改动在同一个事务里提交, 由 argonath.outbox 异步写出去"""
+
+    __tablename__ = 'etcd_outbox'
+
+    path = db.Column(db.String(255), index=True, nullable=False)
+    op = db.Column(db.String(32), nullable=False)
+    payload = db.Column(db.Text)
+    time = db.Column(db.DateTime, default=datetime.datetime.now)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, path, op, payload=None):
+        self.path = path
+        self.op = op
+        self.payload = json.dumps(payload)
+        self.attempts = 0
+
+    @classmethod
+    def pending(cls, limit=500, skip_paths=()):
+        """最老的 limit 条, skip_paths 是正在退避的 path, 整个跳过, 不然同一个 path 的顺序就乱了"""
+        q = cls.query
+        if skip_paths:
+            q = q.filter(~cls.path.in_(list(skip_paths)))
+        return q.order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def bury(cls, rows):
+        """挪到 etcd_outbox_dead, 跟调用方一起 commit"""
+        for r in rows:
+            db.session.add(EtcdOutboxDead(r))
+        cls.query.filter(cls.id.in_([r.id for r in rows])).delete(synchronize_session=False)
+
+    def get_payload(self):
+        return json.loads(self.payload)
+
+
+class EtcdOutboxDead(Base):
+    """重试太多次还写不进 etcd 的 outbox, 留着人来看"""
+
+    __tablename__ = 'etcd_outbox_dead'
+
+    path = db.Column(db.String(255), index=True, nullable=False)
+    op = db.Column(db.String(32), nullable=False)
+    payload = db.Column(db.Text)
+    time = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    buried = db.Column(db.DateTime, default=datetime.datetime.now)
+
+    def __init__(self, row):
+        self.path = row.path
+        self.op = row.op
+        self.payload = row.payload
+        self.time = row.time
+        self.attempts = row.attempts
@@ -0,0 +1,131 @@
+# coding: utf-8
+
+import time
+import logging
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import text
+
+from argonath.ext import db
+from argonath.models import EtcdOutbox, apply_etcd_ops
+
+logger = logging.getLogger(__name__)
+
+
+def publish_pending(batch=500, concurrency=16, max_attempts=10, skip_paths=()):
+    """取一批 outbox (跳过 skip_paths), 按 path 合并以后并发写 etcd, 写成功的删掉.
+    失败的 attempts 加一留着以后按顺序重试, 到了 max_attempts 就挪进 etcd_outbox_dead.
+    返回 (取出的条数, 写成功的 path 数, {失败的 path: 重试次数})"""
+    rows = EtcdOutbox.pending(batch, skip_paths)
+    if not rows:
+        return 0, 0, {}
+
+    groups = OrderedDict()
+    for row in rows:
+        groups.setdefault(row.path, []).append(row)
+    items = [(path, [(r.op, r.get_payload()) for r in rs]) for path, rs in groups.iteritems()]
+
+    pool = ThreadPool(min(concurrency, len(items)))
+    try:
+        oks = pool.map(lambda item: apply_etcd_ops(*item), items)
+    finally:
+        pool.close()
+
+    done, failed, dead = [], {}, []
+    for (path, _), ok in zip(items, oks):
+        if ok:
+            done.extend(r.id for r in groups[path])
+            continue
+        for r in groups[path]:
+            r.attempts += 1
+            if r.attempts >= max_attempts:
+                dead.append(r)
+        failed[path] = max(r.attempts for r in groups[path])
+    if done:
+        EtcdOutbox.query.filter(EtcdOutbox.id.in_(done)).delete(synchronize_session=False)
+    if dead:
+        logger.error('giving up %s outbox rows of %s', len(dead),
+                     ', '.join(sorted(set(r.path for r in dead))))
+        EtcdOutbox.bury(dead)
+    db.session.commit()
+    return len(rows), sum(oks), failed
+
+
+class PublisherLock(object):
+    """MySQL 的 GET_LOCK, 拿着锁的连接一直留着, 连接断了锁就没了, 每轮都要确认一下"""
+
+    def __init__(self, name='argonath_etcd_publisher'):
+        self.name = name
+        self.conn = None
+
+    def acquire(self, timeout=10):
+        if self.conn is None:
+            self.conn = db.engine.connect()
+        try:
+            return self.conn.execute(text('SELECT GET_LOCK(:name, :timeout)'),
+                                     name=self.name, timeout=timeout).scalar() == 1
+        except Exception:
+            self.release()
+            raise
+
+    def held(self):
+        if self.conn is None:
+            return False
+        try:
+            return self.conn.execute(text('SELECT IS_USED_LOCK(:name) = CONNECTION_ID()'),
+                                     name=self.name).scalar() == 1
+        except Exception:
+            logger.exception('check publisher lock failed')
+            self.release()
+            return False
+
+    def release(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+
+
+def run(app):
+    """一直 drain outbox. 同一时间只能有一个 publisher, 不然同一个 path 的操作顺序没法保证,
+    所以先拿 MySQL 的锁, 多起的几个就在那等着当备份.
+    写失败的 path 在本进程里按重试次数指数退避, 退避的时候跳过它, 后面的接着发"""
+    batch = app.config['ETCD_OUTBOX_BATCH']
+    interval = app.config['ETCD_OUTBOX_INTERVAL']
+    concurrency = app.config['ETCD_WRITE_CONCURRENCY']
+    max_attempts = app.config['ETCD_OUTBOX_MAX_ATTEMPTS']
+    lock = PublisherLock()
+    backoff = {}
+    with app.app_context():
+        while True:
+            if not lock.held():
+                try:
+                    if not lock.acquire():
+                        continue
+                except Exception:
+                    logger.exception('acquire publisher lock failed')
+                    time.sleep(interval)
+                    continue
+                logger.info('got publisher lock')
+                backoff = {}
+
+            now = time.time()
+            backoff = dict((p, t) for p, t in backoff.iteritems() if t > now)
+            try:
+                n, paths, failed = publish_pending(batch, concurrency, max_attempts, backoff.keys())
+                if n:
+                    logger.info('published %s outbox rows as %s etcd writes, %s paths failed',
+                                n, paths, len(failed))
+                for path, attempts in failed.iteritems():
+                    backoff[path] = now + min(interval * 2 ** attempts, 60)
+            except Exception:
+                logger.exception('publish outbox failed')
+                db.session.rollback()
+                n = paths = 0
+            finally:
+                db.session.remove()
+            if n < batch or not paths:
+                time.sleep(interval)
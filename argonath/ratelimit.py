@@ -0,0 +1,74 @@
+# coding: utf-8
+
+import time
+import threading
+
+
+class TokenBucket(object):
+    """每秒补 rate 个, 最多攒 burst 个"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+
+    def take(self):
+        """拿到了返回 0, 拿不到返回还要等几秒"""
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Admission(object):
+    """进程内的准入控制, 每个 gunicorn worker 一份.
+
+    每个 key (token 或者 IP) 读和写各一个令牌桶, 再加上整个进程正在处理的请求数上限,
+    满了就直接拒掉, 不让请求排队. rate 是 0 就不限.
+    counters 是累计的计数, 监控用.
+    """
+
+    def __init__(self, read_rate, read_burst, write_rate, write_burst,
+                 max_inflight=0, maxsize=10000):
+        self.limits = {'read': (read_rate, read_burst), 'write': (write_rate, write_burst)}
+        self.max_inflight = max_inflight
+        self.maxsize = maxsize
+        self.inflight = 0
+        self.counters = {'admitted': 0, 'limited_read': 0, 'limited_write': 0, 'shed': 0}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def enter(self, key, kind):
+        """放进来返回 0, 要拒掉返回建议多少秒以后再试, 放进来的请求完了要 leave()"""
+        rate, burst = self.limits[kind]
+        with self._lock:
+            if self.max_inflight and self.inflight >= self.max_inflight:
+                self.counters['shed'] += 1
+                return 1
+            if rate:
+                bucket = self._buckets.get((kind, key))
+                if bucket is None:
+                    if len(self._buckets) >= self.maxsize:
+                        self._buckets.clear()
+                    bucket = self._buckets[(kind, key)] = TokenBucket(rate, burst)
+                wait = bucket.take()
+                if wait:
+                    self.counters['limited_' + kind] += 1
+                    return wait
+            self.inflight += 1
+            self.counters['admitted'] += 1
+            return 0
+
+    def leave(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def stats(self):
+        return dict(self.counters, inflight=self.inflight, max_inflight=self.max_inflight,
+                    buckets=len(self._buckets))
@@ -0,0 +1,178 @@
+# coding: utf-8
+
+import os
+import json
+import time
+import logging
+from multiprocessing.pool import ThreadPool
+
+import etcd
+
+from argonath.ext import db
+from argonath.models import (Record, RecordHost, Domain, _etcd, _etcd_delete, _etcd_mkdir,
+        _cas_update, _read_skydns_node, _domain_of_path, _chunks)
+
+logger = logging.getLogger(__name__)
+
+MISSING = 'missing'
+ORPHANED = 'orphaned'
+DIVERGENT = 'divergent'
+
+
+def _list_dir(key):
+    """非递归读一层, 返回 (子目录, 叶子)"""
+    try:
+        r = _etcd.read(key)
+    except etcd.EtcdKeyNotFound:
+        return [], []
+    dirs, leaves = [], []
+    for n in r.leaves:
+        if n.key == key:
+            continue
+        (dirs if n.dir else leaves).append(n)
+    return dirs, leaves
+
+
+def walk_etcd(root='/skydns'):
+    """按反转域名的字典序一个目录一个目录地往下走, 内存里只有一层.
+    产出 (目录, 子目录, 叶子)"""
+    stack = [root]
+    while stack:
+        key = stack.pop()
+        dirs, leaves = _list_dir(key)
+        stack.extend(sorted((d.key for d in dirs), reverse=True))
+        yield key, dirs, sorted(leaves, key=lambda n: n.key)
+
+
+def _valid(value):
+    try:
+        data = json.loads(value)
+    except (TypeError, ValueError):
+        return False
+    return isinstance(data, dict) and all(
+        isinstance(hosts, list) and all(isinstance(h, dict) and 'host' in h for h in hosts)
+        for hosts in data.itervalues())
+
+
+def _is_record_key(key):
+    name = os.path.basename(key)
+    return not name.startswith('.') or name == '.self'
+
+
+def diff(root='/skydns', chunk=500, concurrency=16):
+    """对比 MySQL 和 etcd, 产出 (类型, 对象, key, 说明).
+
+    先走一遍 etcd, 每个目录的叶子按 chunk 个一批去 MySQL 里 IN 查, 找 orphaned 和 divergent;
+    再按 id 顺序分块扫 Record 和 Domain, 找 etcd 里没有的. etcd 里能对上的 Record 数
+    等于表里的总数的话 Record 就不用再扫了.
+    """
+    matched = 0
+    for key, dirs, leaves in walk_etcd(root):
+        if key != root and not dirs and not leaves and \
+                not Domain.query.filter(Domain.reversed_path == key).first():
+            yield ORPHANED, 'dir', key, 'empty dir'
+
+        for part in _chunks([n for n in leaves if _is_record_key(n.key)], chunk):
+            domains = [_domain_of_path(n.key) for n in part]
+            existing = set(d for d, in db.session.query(Record.domain).filter(Record.domain.in_(domains)))
+            for domain, n in zip(domains, part):
+                if domain not in existing:
+                    yield ORPHANED, 'record', n.key, domain
+                    continue
+                matched += 1
+                if not _valid(n.value):
+                    yield DIVERGENT, 'record', n.key, n.value
+
+    pool = ThreadPool(concurrency)
+    try:
+        if matched < Record.query.count():
+            for records in Record.iter_chunks(chunk):
+                indexes = pool.map(lambda path: _read_skydns_node(path)[2],
+                                   [r.skydns_path for r in records])
+                for r, index in zip(records, indexes):
+                    if index is None:
+                        yield MISSING, 'record', r.skydns_path, r.domain
+
+        for domains in Domain.iter_chunks(chunk):
+            nodes = pool.map(_read_dir_flag, [d.reversed_path for d in domains])
+            for d, is_dir in zip(domains, nodes):
+                if is_dir is None:
+                    yield MISSING, 'domain', d.reversed_path, d.domain
+                elif not is_dir:
+                    yield DIVERGENT, 'domain', d.reversed_path, 'not a dir'
+    finally:
+        pool.close()
+
+
+def _read_dir_flag(key):
+    try:
+        return _etcd.read(key).dir
+    except etcd.EtcdKeyNotFound:
+        return None
+
+
+class Repairer(object):
+    """把 diff 攒成 batch 个一批并发修, 每秒最多 rate 个写.
+    divergent 只报告不修, missing record 按 record_host 里的 host 恢复, 没有的话修不了"""
+
+    def __init__(self, rate=100, batch=50, concurrency=16):
+        self.rate = rate
+        self.batch = batch
+        self.pool = ThreadPool(concurrency)
+        self.pending = []
+        self.fixed = 0
+        self.failed = 0
+        self.skipped = 0
+        self._last = time.time()
+
+    def _fix_for(self, kind, what, key, detail):
+        if kind == ORPHANED and what == 'record':
+            return lambda: _etcd_delete(key)
+        if kind == ORPHANED and what == 'dir':
+            return lambda: _etcd.delete(key, dir=True)
+        if kind == MISSING and what == 'domain':
+            return lambda: _etcd_mkdir(key)
+        if kind == MISSING and what == 'record':
+            r = Record.get_by_domain(detail)
+            rows = r and r.host_rows.order_by(RecordHost.id).all()
+            if not rows:
+                return None
+            value = {}
+            for h in rows:
+                value.setdefault(h.cidr, []).append({'host': h.host})
+            return lambda: _cas_update(key, lambda data: data or value)[0] is not None
+        return None
+
+    def add(self, kind, what, key, detail):
+        fix = self._fix_for(kind, what, key, detail)
+        if fix is None:
+            self.skipped += 1
+            return
+        self.pending.append((key, fix))
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def _run(self, item):
+        key, fix = item
+        try:
+            return fix() is not False
+        except Exception:
+            logger.exception('repair %s failed', key)
+            return False
+
+    def flush(self):
+        if not self.pending:
+            return
+        # 按 rate 限速: 这一批至少要占 len/rate 秒
+        wait = len(self.pending) / float(self.rate) - (time.time() - self._last)
+        if wait > 0:
+            time.sleep(wait)
+        oks = self.pool.map(self._run, self.pending)
+        self.fixed += sum(oks)
+        self.failed += len(oks) - sum(oks)
+        self.pending = []
+        self._last = time.time()
+
+    def close(self):
+        self.flush()
+        self.pool.close()
@@ -0,0 +1,52 @@
+# coding: utf-8
+
+import threading
+
+
+class VersionedCache(object):
+    """进程内缓存 Domain / CIDR 这种很少变又老被读的小表.
+
+    每份数据带着加载时的版本号, version() 返回 {name: 版本},
+    跟缓存的版本不一样就重新 load, 别的 worker 改了表下一次检查版本就能看到.
+    """
+
+    def __init__(self, version, **loaders):
+        self.version = version
+        self.loaders = loaders
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        v = self.version().get(name, 0)
+        item = self._data.get(name)
+        if item is None or item[0] != v:
+            with self._lock:
+                item = self._data.get(name)
+                if item is None or item[0] != v:
+                    item = self._data[name] = (v, self.loaders[name]())
+        return item[1]
+
+    def invalidate(self, name):
+        """本进程自己改了表, 不等版本号直接扔掉"""
+        self._data.pop(name, None)
+
+
+class DomainIndex(object):
+    """按 label 反过来存的后缀树, 查一个域名是不是注册过的父域名只要走一遍 label"""
+
+    def __init__(self, domains):
+        self.domains = sorted(domains)
+        self._tree = {}
+        for d in self.domains:
+            node = self._tree
+            for label in reversed(d.split('.')):
+                node = node.setdefault(label, {})
+            node[None] = d
+
+    def __contains__(self, domain):
+        node = self._tree
+        for label in reversed(domain.split('.')):
+            node = node.get(label)
+            if node is None:
+                return False
+        return None in node
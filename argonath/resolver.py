@@ -0,0 +1,63 @@
+# coding: utf-8
+
+from netaddr import IPAddress, IPNetwork
+
+_WIDTH = {4: 32, 6: 128}
+
+
+class CIDRTree(object):
+    """按位的前缀树, 做最长前缀匹配, IPv4 和 IPv6 各一棵.
+    节点是 [0 子树, 1 子树, 挂在这个前缀上的值]"""
+
+    def __init__(self):
+        self._roots = {4: [None, None, None], 6: [None, None, None]}
+
+    def _bits(self, value, width, n):
+        for i in xrange(width - 1, width - 1 - n, -1):
+            yield (value >> i) & 1
+
+    def insert(self, network, value):
+        net = IPNetwork(network)
+        node = self._roots[net.version]
+        for bit in self._bits(net.first, _WIDTH[net.version], net.prefixlen):
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = value
+
+    def lookup(self, ip):
+        """ip 落在的所有前缀上的值, 最长的在前面"""
+        addr = IPAddress(ip)
+        node = self._roots[addr.version]
+        found = [node[2]] if node[2] is not None else []
+        for bit in self._bits(addr.value, _WIDTH[addr.version], _WIDTH[addr.version]):
+            node = node[bit]
+            if node is None:
+                break
+            if node[2] is not None:
+                found.append(node[2])
+        found.reverse()
+        return found
+
+
+class ViewResolver(object):
+    """client IP 属于哪个 CIDR (view), cidrs 是 [(name, cidr), ...]"""
+
+    def __init__(self, cidrs):
+        self.cidrs = list(cidrs)
+        self.tree = CIDRTree()
+        for name, cidr in self.cidrs:
+            self.tree.insert(cidr, (name, cidr))
+
+    def views(self, client):
+        """[(name, cidr), ...], 最长前缀在前"""
+        return self.tree.lookup(client)
+
+    def resolve(self, hosts, client, default):
+        """hosts 是 Record.hosts, 返回 (命中的 view, 这个 client 拿到的 host 列表).
+        从最长的前缀往短里找, 记录里有这个 view 就用它, 都没有就用 default"""
+        for name, cidr in self.views(client):
+            for key in (cidr, name):
+                if hosts.get(key):
+                    return key, hosts[key]
+        return default, hosts.get(default, [])
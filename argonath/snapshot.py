@@ -0,0 +1,113 @@
+# coding: utf-8
+
+import json
+import gzip
+import logging
+import datetime
+
+from argonath.ext import db
+from argonath.utils import gzip_stream
+from argonath.models import (User, Domain, CIDR, Record, RecordHost, RefVersion, reference,
+        _etcd_set_many, _etcd_mkdir, _chunks, _parse_reversed_domain)
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 按这个顺序导出和导入, record 依赖 user, record_host 依赖 record
+MODELS = (User, Domain, CIDR, Record, RecordHost)
+_models = dict((m.__tablename__, m) for m in MODELS)
+
+
+def _row(obj):
+    d = {}
+    for c in obj.__table__.columns:
+        v = getattr(obj, c.key)
+        if isinstance(v, datetime.datetime):
+            v = v.strftime(TIME_FORMAT)
+        d[c.key] = v
+    return d
+
+
+def _parse_row(model, d):
+    for c in model.__table__.columns:
+        if isinstance(c.type, db.DateTime) and d.get(c.key):
+            d[c.key] = datetime.datetime.strptime(d[c.key], TIME_FORMAT)
+    return d
+
+
+def iter_lines(chunk=500):
+    """每行一个 JSON: 开头是 header, 然后每块是 {"table", "rows"}, record 的行带着 skydns 的值"""
+    yield {'type': 'header', 'version': FORMAT_VERSION,
+           'time': datetime.datetime.now().strftime(TIME_FORMAT)}
+    counts = {}
+    for model in MODELS:
+        for rows in model.iter_chunks(chunk):
+            if model is Record:
+                Record.prefetch_hosts(rows)
+                data = [dict(_row(r), skydns=r.skydns_data) for r in rows]
+            else:
+                data = [_row(r) for r in rows]
+            counts[model.__tablename__] = counts.get(model.__tablename__, 0) + len(data)
+            yield {'type': 'rows', 'table': model.__tablename__, 'rows': data}
+    yield {'type': 'footer', 'counts': counts}
+
+
+def iter_dump(chunk=500):
+    """gzip 压缩之后的快照, 一块一块吐出来, 可以直接当 Response 的 body"""
+    return gzip_stream(json.dumps(line) + '\n' for line in iter_lines(chunk))
+
+
+def dump(fileobj, chunk=500):
+    for data in iter_dump(chunk):
+        fileobj.write(data)
+
+
+def restore(fileobj):
+    """从 dump 出来的文件恢复到空库, 每块一次 executemany 插入, etcd 并发写.
+    返回 (每张表恢复的行数, etcd 写失败的个数)"""
+    counts = {}
+    failed = 0
+    domain_paths = set()
+    for line in gzip.GzipFile(fileobj=fileobj, mode='rb'):
+        item = json.loads(line)
+        if item['type'] == 'header':
+            if item['version'] != FORMAT_VERSION:
+                raise ValueError('unknown snapshot version %s' % item['version'])
+            continue
+        if item['type'] != 'rows':
+            continue
+
+        model = _models[item['table']]
+        rows = [_parse_row(model, r) for r in item['rows']]
+        writes = []
+        for r in rows:
+            skydns = r.pop('skydns', None)
+            if model is Record and skydns:
+                path = _parse_reversed_domain(r['domain'])
+                if path in domain_paths:
+                    path += '/.self'
+                writes.append((path, json.dumps(skydns)))
+        db.session.execute(model.__table__.insert(), rows)
+        db.session.commit()
+
+        if model is Domain:
+            for r in rows:
+                domain_paths.add(r['reversed_path'])
+                _etcd_mkdir(r['reversed_path'])
+        for part in _chunks(writes, 1000):
+            for (key, _), e in zip(part, _etcd_set_many(part)):
+                if e is not None:
+                    logger.error('restore %s to etcd failed: %s', key, e)
+                    failed += 1
+        counts[item['table']] = counts.get(item['table'], 0) + len(rows)
+
+    # 直接 insert 的, 不加版本号别的 worker 会一直用恢复之前缓存的 Domain / CIDR
+    names = [n for n in ('domain', 'cidr') if counts.get(n)]
+    for name in names:
+        RefVersion.bump(name)
+    db.session.commit()
+    for name in names:
+        reference.invalidate(name)
+    return counts, failed
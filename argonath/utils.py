@@ -1,12 +1,19 @@
 # coding: utf-8
 
 import json
+import zlib
 from datetime import datetime
 from functools import wraps
-from flask import abort, g, Response, url_for, redirect
+from flask import abort, g, request, Response, url_for, redirect
 
 from argonath.models import Base
 
+# 装了 simplejson (带 C 扩展) 就用它序列化响应, 比标准库的 json 快
+try:
+    import simplejson as _json
+except ImportError:
+    _json = json
+
 
 def need_login(f):
     @wraps(f)
@@ -41,18 +48,63 @@ def paginator_kwargs(kw):
     d = kw.copy()
     d.pop('start', None)
     d.pop('limit', None)
+    d.pop('before', None)
     return d
 
 
-class ArgonathJSONEncoder(json.JSONEncoder):
+class ArgonathJSONEncoder(_json.JSONEncoder):
+    def __init__(self, *args, **kwargs):
+        self.fields = kwargs.pop('fields', None)
+        super(ArgonathJSONEncoder, self).__init__(*args, **kwargs)
+
     def default(self, obj):
         if isinstance(obj, Base):
-            return obj.to_dict()
+            return obj.to_dict(self.fields)
         if isinstance(obj, datetime):
-            return obj.strftime('%Y-%m-%d %H:%M:%S')
+            # 跟 strftime('%Y-%m-%d %H:%M:%S') 一样, 快很多
+            return obj.isoformat(' ')[:19]
         return super(ArgonathJSONEncoder, self).default(obj)
 
 
+def dumps(obj, fields=None):
+    """fields 是 model 要输出的字段, None 是全部"""
+    return _json.dumps(obj, cls=ArgonathJSONEncoder, fields=fields)
+
+
+def parse_fields(s):
+    """"domain,id" -> frozenset(['domain', 'id']), 空的是 None"""
+    fields = frozenset(f.strip() for f in s.split(',') if f.strip())
+    return fields or None
+
+
+def async_worker():
+    """gunicorn 的 gevent worker 会 patch socket, 这时候一个请求挂着等不会占住整个 worker"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+def gzip_stream(chunks, level=6):
+    """把一块一块的字符串压成 gzip 流, 也是一块一块地吐"""
+    z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = z.compress(chunk)
+        if data:
+            yield data
+    yield z.flush()
+
+
+def check_etag(etag):
+    """If-None-Match 对得上就直接 304, 不用再序列化; 对不上 jsonize 会把 ETag 加到响应头里"""
+    if request.if_none_match.contains(etag):
+        r = Response(status=304)
+        r.set_etag(etag)
+        abort(r)
+    g.etag = etag
+
+
 def jsonize(f):
     @wraps(f)
     def _(*args, **kwargs):
@@ -61,5 +113,8 @@ def jsonize(f):
             data, code = r
         else:
             data, code = r, 200
-        return Response(json.dumps(data, cls=ArgonathJSONEncoder), status=code, mimetype='application/json')
+        resp = Response(dumps(data, getattr(g, 'fields', None)), status=code, mimetype='application/json')
+        if code == 200 and getattr(g, 'etag', None):
+            resp.set_etag(g.etag)
+        return resp
     return _
@@ -1,9 +1,17 @@
 # encoding: utf-8
 
-from flask import url_for, redirect, g, render_template, Blueprint, flash, request, abort
+import os
+from datetime import datetime
 
-from argonath.utils import need_admin
-from argonath.models import User, Record, CIDR, Domain, health_check
+from flask import (url_for, redirect, g, render_template, Blueprint, flash,
+        request, abort, current_app, Response, stream_with_context)
+
+from argonath.utils import need_admin, jsonize
+from argonath.jobs import runner
+from argonath.snapshot import iter_dump
+from argonath.models import (User, Record, CIDR, Domain, TransferJob,
+        health_monitor, skydns_mirror, cas_stats)
+from argonath.views.api import admission
 
 bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -42,7 +50,7 @@ def create_record():
 
 @bp.route('/list/')
 def list_my_records():
-    records, total = g.user.list_records(g.start, g.limit)
+    records, total = g.user.list_records(g.start, g.limit, g.before)
     return render_template('admin_list.html',
             records=records, total=total, endpoint='admin.list_my_records')
 
@@ -50,20 +58,51 @@ def list_my_records():
 @bp.route('/user_records/<username>/')
 def user_records(username):
     user = User.get_by_name(username)
-    return render_template('user_records.html', user=user)
+    if not user:
+        abort(404)
+    records, total = user.list_records(g.start, g.limit, g.before)
+    Record.prefetch_hosts(records)
+    return render_template('user_records.html', user=user, records=records,
+            total=total, endpoint='admin.user_records', username=username)
 
 
 @bp.route('/transfer/<username>/', methods=['POST'])
 def transfer(username):
     source_user = User.get_by_name(username)
-    User.transfer(source_user, g.user)
-    flash(u'转移了{0}的域名'.format(username))
-    return redirect(url_for('admin.index'))
+    if not source_user:
+        abort(404)
+    job = User.transfer(source_user, g.user)
+    runner.kick(current_app._get_current_object())
+    return redirect(url_for('admin.transfer_job', id=job.id))
+
+
+def _get_transfer_job(id):
+    job = TransferJob.get(id)
+    if not job:
+        abort(404)
+    # 跑它的进程挂了的话, 有人来看就让它接着跑
+    if not job.finished():
+        runner.kick(current_app._get_current_object())
+    return job
+
+
+@bp.route('/transfer/job/<int:id>/')
+def transfer_job(id):
+    job = _get_transfer_job(id)
+    users = dict((u.id, u) for u in User.get_multi([job.source_id, job.target_id]) if u)
+    return render_template('transfer_job.html', job=job,
+            source=users.get(job.source_id), target=users.get(job.target_id))
+
+
+@bp.route('/transfer/job/<int:id>/json')
+@jsonize
+def transfer_job_json(id):
+    return {'r': 0, 'message': 'ok', 'data': _get_transfer_job(id)}
 
 
 @bp.route('/domain/')
 def domain_show():
-    domains, total = Domain.list_domains()
+    domains, total = Domain.list_domains(g.start, g.limit, g.before)
     return render_template('list_domains.html', domains=domains, total=total, endpoint='admin.domain_show')
 
 
@@ -96,7 +135,7 @@ def delete_domain(id):
 
 @bp.route('/cidrs/')
 def cidrs_show():
-    cidrs, total = CIDR.list_cidrs(g.start, g.limit)
+    cidrs, total = CIDR.list_cidrs(g.start, g.limit, g.before)
     return render_template('list_cidrs.html', cidrs=cidrs, total=total, endpoint='admin.cidrs_show')
 
 
@@ -161,8 +200,39 @@ def edit_cidr(id):
 
 @bp.route('/health/', methods=['GET'])
 def health():
-    health_info = health_check()
-    return render_template('health.html', health_info=health_info)
+    health_info = health_monitor.check()
+    mirror = current_app.config['ETCD_MIRROR'] and skydns_mirror.status()
+    return render_template('health.html', health_info=health_info,
+            history_of=health_monitor.history_of, mirror=mirror)
+
+
+@bp.route('/health/json', methods=['GET'])
+@jsonize
+def health_json():
+    data = {}
+    for nodename, rs in health_monitor.check().iteritems():
+        data[nodename] = dict(rs, history=health_monitor.history_of(nodename))
+    return {'r': 0, 'message': 'ok', 'data': data}
+
+
+@bp.route('/stats/json', methods=['GET'])
+@jsonize
+def stats_json():
+    """本进程的计数, 每个 worker 各是各的"""
+    return {'r': 0, 'message': 'ok', 'data': {
+        'pid': os.getpid(),
+        'api_admission': admission.stats(),
+        'etcd_cas': cas_stats,
+        'skydns_mirror': skydns_mirror.status(),
+        'startup': getattr(current_app, 'startup_timings', []),
+    }}
+
+
+@bp.route('/snapshot/', methods=['GET'])
+def snapshot():
+    filename = 'argonath-%s.snapshot.gz' % datetime.now().strftime('%Y%m%d%H%M%S')
+    return Response(stream_with_context(iter_dump()), mimetype='application/gzip',
+            headers={'Content-Disposition': 'attachment; filename=%s' % filename})
 
 
 @bp.errorhandler(403)
@@ -1,26 +1,91 @@
 # coding: utf-8
 
-from flask import Blueprint, request, g, abort
+import math
 
-from argonath.models import User, Record, Domain
-from argonath.utils import api_need_token, jsonize
+from flask import (Blueprint, request, g, abort, current_app, Response,
+        stream_with_context)
+
+from netaddr import AddrFormatError
+
+from argonath.config import (API_READ_RATE, API_READ_BURST, API_WRITE_RATE,
+        API_WRITE_BURST, API_MAX_INFLIGHT)
+from argonath.ext import db
+from argonath.mirror import EventsExpired
+from argonath.ratelimit import Admission
+from argonath.models import User, Record, RecordHost, Domain, CIDR, watch_skydns
+from argonath.utils import (api_need_token, jsonize, gzip_stream, check_etag,
+        dumps, parse_fields, async_worker)
 
 bp = Blueprint('api', __name__, url_prefix='/_api')
 
+admission = Admission(API_READ_RATE, API_READ_BURST, API_WRITE_RATE, API_WRITE_BURST,
+                      API_MAX_INFLIGHT)
+
+# 用 POST 但是只读的接口, 算读的额度
+_read_endpoints = frozenset(['api.batch_get_records'])
+
+
+def _wants_hosts():
+    """?fields= 里没有 host 的话就不用读 etcd"""
+    return g.fields is None or 'host' in g.fields
+
+
+def _wants_comments():
+    return g.fields is None or 'comments' in g.fields
+
+
+def _prefetch(records, fields=None):
+    """一页记录要输出的 host 和备注一起批量读好"""
+    if fields is None or 'host' in fields:
+        Record.prefetch_hosts(records)
+    if fields is None or 'comments' in fields:
+        Record.prefetch_comments(records)
+
+
+def _next_cursor(records):
+    """下一页的 before 参数, 没有下一页了就是 None"""
+    if records and len(records) >= g.limit:
+        return records[-1].id
+    return None
+
 
 @bp.route('/record/all/')
 @jsonize
 def list_all_records():
-    records, _ = Record.list_records(g.start, g.limit)
-    return {'r': 0, 'message': 'ok', 'data': records}
+    records, total = Record.list_records(g.start, g.limit, g.before)
+    _prefetch(records, g.fields)
+    check_etag(Record.list_etag(records, total, _wants_hosts(), _wants_comments()))
+    return {'r': 0, 'message': 'ok', 'data': records,
+            'total': total, 'next': _next_cursor(records)}
+
+
+def _iter_export(chunk, fields=None):
+    """按 id 一块一块地读, 每块一起读 etcd, 一块吐一次, 每条记录一行 JSON"""
+    for records in Record.iter_chunks(chunk):
+        _prefetch(records, fields)
+        yield ''.join(dumps(r, fields) + '\n' for r in records)
+
+
+@bp.route('/record/export/')
+def export_records():
+    body = _iter_export(current_app.config['EXPORT_CHUNK'], g.fields)
+    headers = {'Vary': 'Accept-Encoding'}
+    if request.args.get('gzip') or 'gzip' in request.headers.get('Accept-Encoding', ''):
+        body = gzip_stream(body)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(body), mimetype='application/x-ndjson',
+            headers=headers)
 
 
 @bp.route('/record/mine/')
 @jsonize
 @api_need_token
 def list_my_records():
-    records, _ = g.user.list_records(g.start, g.limit)
-    return {'r': 0, 'message': 'ok', 'data': records}
+    records, total = g.user.list_records(g.start, g.limit, g.before)
+    _prefetch(records, g.fields)
+    check_etag(Record.list_etag(records, total, _wants_hosts(), _wants_comments()))
+    return {'r': 0, 'message': 'ok', 'data': records,
+            'total': total, 'next': _next_cursor(records)}
 
 
 @bp.route('/record/<int:record_id>/')
@@ -29,9 +94,45 @@ def get_record(record_id):
     record = Record.get(record_id)
     if not record:
         abort(400, u'没有找到记录')
+    check_etag(record.etag(_wants_hosts(), _wants_comments()))
     return {'r': 0, 'message': 'ok', 'data': record}
 
 
+def _batch_keys():
+    """GET 是 ?ids=1,2&domains=a,b, POST 是 {"ids": [...], "domains": [...]}"""
+    if request.method == 'POST':
+        body = request.get_json(force=True, silent=True)
+        if not isinstance(body, dict):
+            abort(400, u'需要一个 JSON 对象')
+        ids, domains = body.get('ids') or [], body.get('domains') or []
+        if not isinstance(ids, list) or not isinstance(domains, list):
+            abort(400, u'ids 和 domains 要是列表')
+    else:
+        ids = [i for i in request.args.get('ids', default='').split(',') if i.strip()]
+        domains = request.args.get('domains', default='').split(',')
+    try:
+        ids = [int(i) for i in ids]
+    except (TypeError, ValueError):
+        abort(400, u'id 要是整数')
+    domains = [unicode(d).strip() for d in domains if d and unicode(d).strip()]
+    if len(ids) + len(domains) > current_app.config['API_BATCH_MAX']:
+        abort(400, u'一次最多查 %s 个' % current_app.config['API_BATCH_MAX'])
+    return ids, domains
+
+
+@bp.route('/record/batch/', methods=['GET', 'POST'])
+@jsonize
+def batch_get_records():
+    ids, domains = _batch_keys()
+    by_id, by_domain = Record.get_batch(ids, domains)
+    _prefetch(set(by_id.values()) | set(by_domain.values()), g.fields)
+    return {'r': 0, 'message': 'ok',
+            'data': {'ids': dict((i, by_id.get(i)) for i in ids),
+                     'domains': dict((d, by_domain.get(d)) for d in domains)},
+            'missing': {'ids': [i for i in ids if i not in by_id],
+                        'domains': [d for d in domains if d not in by_domain]}}
+
+
 @bp.route('/record/search/')
 @jsonize
 def query_record():
@@ -42,30 +143,126 @@ def query_record():
     return {'r': 0, 'message': 'ok', 'data': r}
 
 
+@bp.route('/record/find/')
+@jsonize
+def find_records():
+    query = request.args.get('q', default='').strip()
+    if not query:
+        abort(400, u'需要 q')
+    records, total = Record.search(query, g.start, g.limit, g.before)
+    _prefetch(records, g.fields)
+    return {'r': 0, 'message': 'ok', 'data': records,
+            'total': total, 'next': _next_cursor(records)}
+
+
+@bp.route('/record/by-host/')
+@jsonize
+def find_records_by_host():
+    host_or_ip = request.args.get('host', default='').strip()
+    if not host_or_ip:
+        abort(400, u'需要 host')
+    return {'r': 0, 'message': 'ok', 'data': RecordHost.find_by_host(host_or_ip, g.limit)}
+
+
+@bp.route('/resolve/')
+@jsonize
+def resolve():
+    domain = request.args.get('domain', default='').strip()
+    client = request.args.get('client', default=request.remote_addr or '').strip()
+    record = Record.get_by_domain(domain)
+    if not record:
+        abort(404, u'没有找到记录')
+    try:
+        view, hosts = CIDR.resolver().resolve(record.hosts, client,
+                current_app.config['DEFAULT_NET'])
+    except (AddrFormatError, ValueError):
+        abort(400, u'client 不是合法的 IP')
+    return {'r': 0, 'message': 'ok',
+            'data': {'domain': domain, 'client': client, 'view': view, 'hosts': hosts}}
+
+
+def _watch_args():
+    limit = current_app.config['WATCH_TIMEOUT' if async_worker() else 'WATCH_SYNC_TIMEOUT']
+    timeout = min(request.args.get('wait', type=int, default=limit), limit)
+    return dict(domain=request.args.get('domain', default='').strip(),
+                subtree=request.args.get('subtree', default='').strip(),
+                timeout=max(timeout, 0))
+
+
+def _iter_watch_events(since, kw):
+    """server-sent events, 没有变化的时候每隔 timeout 秒发一个注释当心跳"""
+    try:
+        while True:
+            events, since = watch_skydns(since, **kw)
+            for e in events:
+                yield 'id: %s\ndata: %s\n\n' % (e['index'], dumps(e))
+            if not events:
+                yield ': %s\n\n' % since
+    except EventsExpired:
+        yield 'event: expired\ndata: %s\n\n' % dumps({'index': since})
+
+
+@bp.route('/watch/')
+def watch():
+    since = request.args.get('index', type=int, default=None)
+    if since is None and request.headers.get('Last-Event-ID', '').isdigit():
+        since = int(request.headers['Last-Event-ID'])
+    # 以前镜像没同步完的时候会给出去 0, 当成从现在开始
+    since = since or None
+    kw = _watch_args()
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        if not async_worker():
+            abort(400, u'server-sent events 要 gevent worker, 用长轮询吧')
+        kw['timeout'] = kw['timeout'] or current_app.config['WATCH_TIMEOUT']
+        # stream_with_context 让 teardown 等流结束了才跑, 流开着的时候一直占着准入的名额;
+        # 流里不查库, 先把连接还回去
+        db.session.remove()
+        return Response(stream_with_context(_iter_watch_events(since, kw)),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    return _long_poll(since, kw)
+
+
+@jsonize
+def _long_poll(since, kw):
+    try:
+        events, index = watch_skydns(since, **kw)
+    except EventsExpired:
+        return {'r': 1, 'message': u'index 太老了, 重新全量读一次再 watch', 'index': since}, 410
+    return {'r': 0, 'message': 'ok', 'data': events, 'index': index}
+
+
+def _build_domain(name, subname, subnames):
+    """按创建记录的规则拼出完整域名, 返回 (domain, 错误信息)"""
+    # 给跪了, 不是admin就判断subname什么的
+    if not g.user.is_admin():
+        if len(name) < 5:
+            return None, u'域名长度必须大于5'
+        if '.' in name:
+            return None, u'域名不能包含"."'
+        if subname not in subnames:
+            return None, u'不正确的子域名'
+        return '%s.%s' % (name, subname), None
+    # 是admin就很暴力了...
+    # 可以随便传域名的哦...
+    if name.startswith('.') or name.endswith('.'):
+        return None, u'域名不能以"."开始或者结束, 并不是dnspod啊  (￣▽￣")'
+    return name, None
+
+
 @bp.route('/record/create/', methods=['POST'])
 @jsonize
 @api_need_token
 def create_record():
     name = request.form.get('name', default='').strip()
+    subname = request.form.get('subname', default='').strip()
     host_or_ip = request.form.get('host', default='').strip()
     comment = request.form.get('comment', default='').strip()
 
-    # 给跪了, 不是admin就判断subname什么的
-    if not g.user.is_admin():
-        subname = request.form.get('subname', default='').strip()
-        if len(name) < 5 and not g.user.is_admin():
-            abort(400, u'域名长度必须大于5')
-        if '.' in name:
-            abort(400, u'域名不能包含"."')
-        if not Domain.get_by_name(subname):
-            abort(400, u'不正确的子域名')
-        domain = '%s.%s' % (name, subname)
-    # 是admin就很暴力了...
-    # 可以随便传域名的哦...
-    else:
-        if name.startswith('.') or name.endswith('.'):
-            abort(400, u'域名不能以"."开始或者结束, 并不是dnspod啊  (￣▽￣")')
-        domain = name
+    subnames = () if g.user.is_admin() else Domain.existing([subname])
+    domain, error = _build_domain(name, subname, subnames)
+    if error:
+        abort(400, error)
 
     r = Record.get_by_domain(domain)
     if r:
@@ -77,6 +274,86 @@ def create_record():
     return {'r': 0, 'message': 'ok', 'data': r}
 
 
+@bp.route('/record/bulk-create/', methods=['POST'])
+@jsonize
+@api_need_token
+def bulk_create_records():
+    items = request.get_json(force=True, silent=True)
+    if isinstance(items, dict):
+        items = items.get('records')
+    if not isinstance(items, list):
+        abort(400, u'需要一个 JSON 列表')
+    if len(items) > current_app.config['API_BULK_MAX']:
+        abort(400, u'一次最多创建 %s 条' % current_app.config['API_BULK_MAX'])
+
+    items = [i if isinstance(i, dict) else {} for i in items]
+    subnames = () if g.user.is_admin() else \
+            Domain.existing(unicode(i.get('subname') or '').strip() for i in items)
+
+    results, valid = [], []
+    for i in items:
+        name = unicode(i.get('name') or '').strip()
+        subname = unicode(i.get('subname') or '').strip()
+        host_or_ip = unicode(i.get('host') or '').strip()
+        comment = unicode(i.get('comment') or '').strip()
+
+        domain, error = _build_domain(name, subname, subnames)
+        if not error and not host_or_ip:
+            error = u'必须填写一个host'
+        rs = {'domain': domain, 'id': None, 'r': 1, 'message': error}
+        results.append(rs)
+        if not error:
+            valid.append((rs, (name, domain, host_or_ip, comment)))
+
+    created = Record.bulk_create(g.user, [item for _, item in valid])
+    for (rs, _), c in zip(valid, created):
+        rs.update(c)
+    return {'r': 0, 'message': 'ok', 'data': results}
+
+
+@bp.route('/record/<int:record_id>/hosts/add/', methods=['POST'])
+@jsonize
+@api_need_token
+def add_host_to_record(record_id):
+    record = Record.get(record_id)
+    if not record:
+        abort(404, u'没有找到记录')
+    if not record.can_do(g.user):
+        abort(403, u'没有权限编辑这个记录')
+
+    cidr = request.form.get('cidr', default='').strip()
+    host_or_ip = request.form.get('host', default='').strip()
+    comment = request.form.get('comment', default='').strip()
+    if not cidr or not host_or_ip:
+        abort(400, u'需要 cidr 和 host')
+
+    stats = record.add_host(cidr, host_or_ip, comment)
+    if not stats['ok']:
+        return {'r': 1, 'message': u'冲突太多, 重试吧', 'data': {'cas': stats}}, 409
+    return {'r': 0, 'message': 'ok', 'data': {'record': record, 'cas': stats}}
+
+
+@bp.route('/record/<int:record_id>/hosts/delete/', methods=['POST'])
+@jsonize
+@api_need_token
+def delete_host_from_record(record_id):
+    record = Record.get(record_id)
+    if not record:
+        abort(404, u'没有找到记录')
+    if not record.can_do(g.user):
+        abort(403, u'没有权限编辑这个记录')
+
+    cidr = request.form.get('cidr', default='').strip()
+    host_or_ip = request.form.get('host', default='').strip()
+    if not cidr or not host_or_ip:
+        abort(400, u'需要 cidr 和 host')
+
+    stats = record.delete_host(cidr, host_or_ip)
+    if not stats['ok']:
+        return {'r': 1, 'message': u'冲突太多, 重试吧', 'data': {'cas': stats}}, 409
+    return {'r': 0, 'message': 'ok', 'data': {'record': record, 'cas': stats}}
+
+
 @bp.route('/record/<record_id>/', methods=['DELETE'])
 @jsonize
 @api_need_token
@@ -95,11 +372,32 @@ def init_global_vars():
     token = request.args.get('token')
     if not token:
         token = request.headers.get('X-Argonath-Token', '')
-    g.user = User.get_by_token(token)
+    g.user = token and User.get_by_token_cached(token) or None
+    g.fields = parse_fields(request.args.get('fields', default=''))
+
+    key = g.user and g.user.id or request.remote_addr
+    if request.method in ('GET', 'HEAD', 'OPTIONS') or request.endpoint in _read_endpoints:
+        kind = 'read'
+    else:
+        kind = 'write'
+    wait = admission.enter(key, kind)
+    if wait:
+        return Response(dumps({'r': 1, 'message': u'请求太多了, 等一下再试', 'data': None}),
+                status=429, mimetype='application/json',
+                headers={'Retry-After': str(int(math.ceil(wait)))})
+    g.admitted = True
+
+
+@bp.teardown_request
+def release_admission(exc):
+    if getattr(g, 'admitted', False):
+        g.admitted = False
+        admission.leave()
 
 
 @bp.errorhandler(400)
 @bp.errorhandler(403)
+@bp.errorhandler(404)
 @jsonize
 def errorhandler(error):
     return {'r': 1, 'message': error.description, 'data': None}, error.code
@@ -11,7 +11,7 @@ bp = Blueprint('record', __name__, url_prefix='/record')
 
 @bp.route('/all/')
 def list_all_records():
-    records, total = Record.list_records(g.start, g.limit)
+    records, total = Record.list_records(g.start, g.limit, g.before)
     return render_template('list_records.html', records=records,
             total=total, endpoint='record.list_all_records')
 
@@ -19,7 +19,7 @@ def list_all_records():
 @bp.route('/mine/')
 @need_login
 def list_my_records():
-    records, total = g.user.list_records(g.start, g.limit)
+    records, total = g.user.list_records(g.start, g.limit, g.before)
     return render_template('list_records.html', records=records,
             total=total, endpoint='record.list_my_records')
 
@@ -35,11 +35,16 @@ def get_record(record_id):
 
 @bp.route('/search/')
 def query_record():
-    query = request.args.get('q', default='')
-    r = Record.get_by_name(query)
-    if not r:
+    query = request.args.get('q', default='').strip()
+    if not query:
         abort(404)
-    return render_template('record.html', record=r)
+    records, total = Record.search(query, g.start, g.limit, g.before)
+    # 精确查到一条就直接去详情页, 看的是这次真查出来的, 缓存的总数可能已经过时了
+    if len(records) == 1 and not g.start and not g.before \
+            and '*' not in query and '?' not in query:
+        return redirect(url_for('record.get_record', record_id=records[0].id))
+    return render_template('list_records.html', records=records, total=total,
+            endpoint='record.query_record', q=query)
 
 
 @bp.route('/create/', methods=['GET', 'POST'])
@@ -60,7 +65,7 @@ def create_record():
     if '.' in name:
         flash(u'域名不能包含"."', 'error')
         return redirect(url_for('record.create_record'))
-    if not Domain.get_by_name(subname):
+    if subname not in Domain.index():
         flash(u'不正确的子域名', 'error')
         return redirect(url_for('record.create_record'))
     domain = '%s.%s' % (name, subname)
@@ -83,7 +88,7 @@ def create_record():
 @need_login
 def edit_record(record_id):
     record = Record.get(record_id)
-    cidrs = CIDR.query.all()
+    cidrs = CIDR.get_all()
     if not record:
         abort(404)
     if not record.can_do(g.user):
@@ -113,7 +118,9 @@ def add_host_to_record(record_id):
         flash(u'需要一个CIDR', 'error')
         return redirect(url_for('record.edit_record', record_id=record.id))
 
-    record.add_host(cidr, host_or_ip, comment)
+    if not record.add_host(cidr, host_or_ip, comment)['ok']:
+        flash(u'同时修改的人太多了, 再试一次吧', 'error')
+        return redirect(url_for('record.edit_record', record_id=record.id))
     return redirect(url_for('record.get_record', record_id=record.id))
 
 
@@ -135,7 +142,8 @@ def delete_host_from_record(record_id):
         flash(u'必须填写一个host', 'error')
         return redirect(url_for('record.edit_record', record_id=record.id))
 
-    record.delete_host(cidr, host_or_ip)
+    if not record.delete_host(cidr, host_or_ip)['ok']:
+        flash(u'同时修改的人太多了, 再试一次吧', 'error')
     return redirect(url_for('record.edit_record', record_id=record.id))
 
 
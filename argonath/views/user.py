@@ -1,7 +1,8 @@
 # coding: utf-8
 
-from flask import Blueprint, request, session, current_app, redirect, url_for, abort
+from flask import Blueprint, request, session, redirect, url_for, abort
 from flask_oauthlib.client import OAuth
+from werkzeug.local import LocalProxy
 from argonath.utils import need_login
 from argonath.models import User
 from argonath import config
@@ -9,22 +10,34 @@ from argonath import config
 bp = Blueprint('user', __name__, url_prefix='/user')
 
 
-oauth = OAuth(current_app)
-remote = oauth.remote_app(
-    'sso',
-    consumer_key=config.OAUTH2_CLIENT_ID,
-    consumer_secret=config.OAUTH2_CLIENT_SECRET,
-    request_token_params={'scope': 'email'},
-    base_url=config.OAUTH2_BASE_URL,
-    request_token_url=None,
-    access_token_url=config.OAUTH2_ACCESS_TOKEN_URL,
-    authorize_url=config.OAUTH2_AUTHORIZE_URL,
-)
+oauth = OAuth()
+_remote = []
+
 
-@remote.tokengetter
 def get_oauth_token():
     return session.get('remote_oauth')
 
+
+def _get_remote():
+    """有人登录的时候才建 OAuth 的 remote app"""
+    if not _remote:
+        r = oauth.remote_app(
+            'sso',
+            consumer_key=config.OAUTH2_CLIENT_ID,
+            consumer_secret=config.OAUTH2_CLIENT_SECRET,
+            request_token_params={'scope': 'email'},
+            base_url=config.OAUTH2_BASE_URL,
+            request_token_url=None,
+            access_token_url=config.OAUTH2_ACCESS_TOKEN_URL,
+            authorize_url=config.OAUTH2_AUTHORIZE_URL,
+        )
+        r.tokengetter(get_oauth_token)
+        _remote.append(r)
+    return _remote[0]
+
+
+remote = LocalProxy(_get_remote)
+
 @bp.route('/authorized')
 def authorized():
     resp = remote.authorized_response()
@@ -4,7 +4,34 @@ bind = '0.0.0.0:%s' % os.getenv('SERVER_PORT', '5000')
 graceful_timeout = 3600
 timeout = 3600
 max_requests = 120
-workers = 2
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+# sync 或者 gevent. gevent 的时候 etcd / MySQL / 健康检查的 IO 都会让出去,
+# 一个 worker 最多同时处理 worker_connections 个请求
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '200'))
+
+if worker_class == 'gevent' and not os.getenv('MYSQL_DRIVER'):
+    # MySQL-python 是 C 扩展, gevent patch 不了它的 socket
+    os.environ['MYSQL_DRIVER'] = 'pymysql'
+
+# 在 master 里加载一次 app, worker 直接 fork, 不用每次重启都 import 一遍.
+# gevent 要在 import 之前 patch, 所以默认只有 sync 才 preload
+preload_app = bool(os.getenv('GUNICORN_PRELOAD', '1' if worker_class == 'sync' else ''))
+
+
+def post_fork(server, worker):
+    # master 里要是连过 MySQL, 连接池不能和子进程共用; etcd 客户端按 pid 自己会重建
+    if server.cfg.preload_app:
+        from argonath.ext import db
+        from app import app
+        with app.app_context():
+            db.get_engine(app).dispose()
+
+
+def post_worker_init(worker):
+    # 开始接请求之前按 WARMUP 预热
+    from argonath.app import warm_up
+    warm_up(worker.wsgi)
 log_level = 'info'
 debug = False
 accesslog = '-'
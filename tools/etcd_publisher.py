@@ -0,0 +1,11 @@
+# coding: utf-8
+
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from argonath.app import create_app
+from argonath.outbox import run
+
+if __name__ == '__main__':
+    run(create_app())
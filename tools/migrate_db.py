@@ -0,0 +1,82 @@
+# coding: utf-8
+
+"""给已经有数据的库补上新加的表/列/索引, 可以重复跑"""
+
+import sys
+import os
+import json
+sys.path.append(os.path.abspath('.'))
+
+from argonath.app import create_app
+from argonath.ext import db
+from argonath.models import Record, RecordHost, RefVersion, _parse_reversed_domain
+
+# (说明, 检查是否已经做过的 SQL, 要执行的 SQL)
+STEPS = [
+    ('record.reversed_path',
+     "SHOW COLUMNS FROM record LIKE 'reversed_path'",
+     ["ALTER TABLE record ADD COLUMN reversed_path VARCHAR(255) NOT NULL DEFAULT ''",
+      "CREATE INDEX ix_record_reversed_path ON record (reversed_path)"]),
+    ('record.updated',
+     "SHOW COLUMNS FROM record LIKE 'updated'",
+     ["ALTER TABLE record ADD COLUMN updated DATETIME NULL"]),
+    ('etcd_outbox.attempts',
+     "SHOW COLUMNS FROM etcd_outbox LIKE 'attempts'",
+     ["ALTER TABLE etcd_outbox ADD COLUMN attempts INT NOT NULL DEFAULT 0"]),
+    ('record_host.comment text',
+     "SHOW COLUMNS FROM record_host WHERE Field = 'comment' AND Type = 'text'",
+     ["ALTER TABLE record_host MODIFY comment TEXT NOT NULL"]),
+    ('record.name index',
+     "SHOW INDEX FROM record WHERE Key_name = 'ix_record_name'",
+     ["CREATE INDEX ix_record_name ON record (name)"]),
+]
+
+
+def backfill_reversed_path():
+    q = Record.query.filter(Record.reversed_path == '')
+    n = 0
+    for records in Record.iter_chunks(1000, q):
+        for r in records:
+            r.reversed_path = _parse_reversed_domain(r.domain)
+        db.session.commit()
+        n += len(records)
+    print 'backfilled reversed_path of %d records' % n
+
+
+def backfill_record_hosts():
+    """把 etcd 里的 host 和老的 comments 列写进 record_host"""
+    q = Record.query.filter(~Record.host_rows.any())
+    n = 0
+    for records in Record.iter_chunks(500, q):
+        Record.prefetch_hosts(records)
+        for r in records:
+            comments = json.loads(r.comments or '{}')
+            for cidr, hosts in r.hosts.iteritems():
+                for h in hosts:
+                    db.session.add(RecordHost(r, cidr, h, comments.get(h, '')))
+        db.session.commit()
+        n += len(records)
+    print 'backfilled hosts of %d records' % n
+
+
+def migrate(app):
+    with app.app_context():
+        # 新加的表直接建
+        db.create_all()
+        for desc, check, sqls in STEPS:
+            if db.session.execute(check).first():
+                continue
+            print 'migrating', desc
+            for sql in sqls:
+                db.session.execute(sql)
+            db.session.commit()
+        for name in ('domain', 'cidr'):
+            if not RefVersion.query.filter(RefVersion.name == name).first():
+                db.session.add(RefVersion(name))
+        db.session.commit()
+        backfill_reversed_path()
+        backfill_record_hosts()
+
+
+if __name__ == '__main__':
+    migrate(create_app())
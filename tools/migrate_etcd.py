@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import os
 import etcd
 import json
 import sys
+import time
+import argparse
+from multiprocessing.pool import ThreadPool
 
 
 def get_node(c, key):
@@ -36,7 +40,154 @@ def check(src):
             continue
         print node.key, v
 
+
+def list_dir(c, key):
+    """非递归读一层, 返回 (子目录 key, {叶子 key: value})"""
+    try:
+        r = c.read(key)
+    except etcd.EtcdKeyNotFound:
+        return [], {}
+    dirs, leaves = [], {}
+    for n in r.leaves:
+        if n.key == key:
+            continue
+        if n.dir:
+            dirs.append(n.key)
+        else:
+            leaves[n.key] = n.value
+    return dirs, leaves
+
+def walk(c, root):
+    """一个目录一个目录地走, 内存里只有一层, 产出 (目录, 叶子)"""
+    stack = [root]
+    while stack:
+        key = stack.pop()
+        dirs, leaves = list_dir(c, key)
+        stack.extend(sorted(dirs, reverse=True))
+        yield key, leaves
+
+
+class Progress(object):
+
+    def __init__(self, every=5):
+        self.every = every
+        self.begin = self.last = time.time()
+        self.written = self.skipped = self.failed = 0
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.last < self.every:
+            return
+        self.last = now
+        elapsed = max(now - self.begin, 0.001)
+        print 'written %d, skipped %d, failed %d, %.1f keys/sec' % (
+            self.written, self.skipped, self.failed, self.written / elapsed)
+
+
+def copy(src, dst, root='/skydns', workers=16, checkpoint=None,
+         skip_identical=False, dry_run=False):
+    """按目录流式复制, 一个目录里的 key 用 workers 个线程并发写.
+    写完的目录记到 checkpoint 文件里, 中断了再跑一次会跳过这些目录."""
+    source_etcd = create(src)
+    target_etcd = create(dst)
+
+    done = set()
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            done = set(line.strip() for line in f if line.strip())
+        print 'resume, %d dirs already copied' % len(done)
+    cp = checkpoint and not dry_run and open(checkpoint, 'a')
+
+    def _set(item):
+        k, v = item
+        try:
+            target_etcd.set(k, v)
+            return True
+        except Exception as e:
+            print 'failed', k, e
+            return False
+
+    pool = ThreadPool(workers)
+    progress = Progress()
+    try:
+        for key, leaves in walk(source_etcd, root):
+            if key in done:
+                continue
+            items = [(k, v) for k, v in sorted(leaves.iteritems())
+                     if v and os.path.basename(k) != '.wildcards']
+            if skip_identical and items:
+                _, existing = list_dir(target_etcd, key)
+                same = [k for k, v in items if existing.get(k) == v]
+                progress.skipped += len(same)
+                items = [(k, v) for k, v in items if existing.get(k) != v]
+
+            if dry_run:
+                for k, v in items:
+                    print 'would set', k, v
+                progress.written += len(items)
+            else:
+                if not leaves and key != root:
+                    try:
+                        target_etcd.write(key, None, dir=True)
+                    except (etcd.EtcdNotFile, etcd.EtcdAlreadyExist):
+                        pass
+                oks = pool.map(_set, items)
+                progress.written += sum(oks)
+                progress.failed += len(oks) - sum(oks)
+                # 有失败的目录不记 checkpoint, 下次还会再来
+                if cp and all(oks):
+                    cp.write(key + '\n')
+                    cp.flush()
+            progress.report()
+    finally:
+        pool.close()
+        if cp:
+            cp.close()
+    progress.report(force=True)
+    return progress
+
+def verify(src, dst, root='/skydns', limit=100):
+    """对比两边, 打印 target 上缺的和不一样的 key, 返回 (missing, different)"""
+    source_etcd = create(src)
+    target_etcd = create(dst)
+    missing = different = 0
+    for key, leaves in walk(source_etcd, root):
+        if not leaves:
+            continue
+        _, existing = list_dir(target_etcd, key)
+        for k, v in sorted(leaves.iteritems()):
+            if not v or os.path.basename(k) == '.wildcards':
+                continue
+            if k not in existing:
+                missing += 1
+                if missing + different <= limit:
+                    print 'missing', k
+            elif existing[k] != v:
+                different += 1
+                if missing + different <= limit:
+                    print 'different', k
+    print 'verify: %d missing, %d different' % (missing, different)
+    return missing, different
+
+
 if __name__=="__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'copy':
+        parser = argparse.ArgumentParser(prog='migrate_etcd.py copy')
+        parser.add_argument('src')
+        parser.add_argument('dst')
+        parser.add_argument('--root', default='/skydns')
+        parser.add_argument('--workers', type=int, default=16)
+        parser.add_argument('--checkpoint', help='file recording copied dirs, used to resume')
+        parser.add_argument('--skip-identical', action='store_true')
+        parser.add_argument('--dry-run', action='store_true')
+        parser.add_argument('--no-verify', action='store_true')
+        args = parser.parse_args(sys.argv[2:])
+        copy(args.src, args.dst, args.root, args.workers, args.checkpoint,
+             args.skip_identical, args.dry_run)
+        if not args.dry_run and not args.no_verify:
+            verify(args.src, args.dst, args.root)
+        sys.exit(0)
+
     src = sys.argv[1]
     dst = sys.argv[2]
     print src, dst
@@ -0,0 +1,39 @@
+# coding: utf-8
+
+import sys
+import os
+import argparse
+sys.path.append(os.path.abspath('.'))
+
+from argonath.app import create_app
+from argonath.reconcile import diff, Repairer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare MySQL with /skydns in etcd')
+    parser.add_argument('--repair', action='store_true', help='fix missing and orphaned keys')
+    parser.add_argument('--rate', type=int, default=100, help='max etcd writes per second')
+    parser.add_argument('--batch', type=int, default=50)
+    parser.add_argument('--chunk', type=int, default=500)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        concurrency = app.config['ETCD_WRITE_CONCURRENCY']
+        repairer = args.repair and Repairer(args.rate, args.batch, concurrency)
+        counts = {}
+        for kind, what, key, detail in diff(chunk=args.chunk, concurrency=concurrency):
+            print kind, what, key, detail
+            counts[kind] = counts.get(kind, 0) + 1
+            if repairer:
+                repairer.add(kind, what, key, detail)
+
+        print ', '.join('%s: %s' % kv for kv in sorted(counts.iteritems())) or 'all consistent'
+        if repairer:
+            repairer.close()
+            print 'fixed: %s, failed: %s, skipped: %s' % (
+                repairer.fixed, repairer.failed, repairer.skipped)
+
+
+if __name__ == '__main__':
+    main()
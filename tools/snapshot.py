@@ -0,0 +1,34 @@
+# coding: utf-8
+
+import sys
+import os
+sys.path.append(os.path.abspath('.'))
+
+from argonath.app import create_app
+from argonath.models import User
+from argonath.snapshot import dump, restore
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('dump', 'restore'):
+        print 'usage: python tools/snapshot.py dump|restore FILE [--force]'
+        sys.exit(1)
+
+    app = create_app()
+    cmd, path = sys.argv[1], sys.argv[2]
+    with app.app_context():
+        if cmd == 'dump':
+            with open(path, 'wb') as f:
+                dump(f)
+            print 'dumped to', path
+        else:
+            if User.query.first() and '--force' not in sys.argv:
+                print 'database is not empty, run tools/flushdb.py first,'
+                print 'if sure, add --force to restore anyway.'
+                sys.exit(1)
+            with open(path, 'rb') as f:
+                counts, failed = restore(f)
+            print counts
+            if failed:
+                print '%d etcd writes failed, see the log above' % failed
+                sys.exit(1)